@@ -0,0 +1,320 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Hook to control path cache and bundle cache folder creation.
+
+Thumbnails downloaded by the Shotgun panel, the loader and workfiles are
+stored in a ``thumbs`` folder inside each bundle's cache. The default cache
+location includes the plugin id, so Nuke, Maya and Houdini sessions each keep
+their own copy. This hook points the ``thumbs`` folder of those bundles at a
+single folder per site so that every engine on the workstation shares it, and
+keeps that folder under a size limit by evicting the least recently used
+thumbnails. Once a session shares the folder, a background thread runs an
+eviction pass every hour for as long as the session lives.
+
+Each eviction pass also adds hit and miss counts to a ``.stats.json`` file in
+the shared folder, see :func:`get_thumbnail_cache_stats`. The apps download
+thumbnails without going through this hook, so the counts are file-level
+estimates taken from timestamps rather than counted requests: a thumbnail
+written since the previous pass counts as one miss, an older one read since
+then as one hit, however often it was requested. Reads are only seen through
+access times, which most filesystems update at most once a day (relatime) or
+never (noatime), so hits are undercounted.
+
+Prefetching thumbnails for the rows an app is about to display is out of
+scope. The apps decide when to download a thumbnail, and a core hook cannot
+influence that.
+"""
+
+import errno
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+import sgtk
+from sgtk.util import LocalFileStorageManager
+from sgtk.util.filesystem import ensure_folder_exists
+
+HookBaseClass = sgtk.get_hook_baseclass()
+
+# bundles whose thumbnail caches are shared
+THUMBNAIL_BUNDLES = [
+    "tk-framework-shotgunutils",
+    "tk-multi-loader2",
+    "tk-multi-shotgunpanel",
+    "tk-multi-workfiles2",
+]
+
+# size limit of the shared thumbnail cache, in megabytes
+THUMBNAIL_CACHE_SIZE_ENV_VAR = "TK_THUMBNAIL_CACHE_MB"
+THUMBNAIL_CACHE_SIZE_DEFAULT = 2048
+
+# eviction trims the cache down to this fraction of the limit, so that it
+# does not run again as soon as the next thumbnail is downloaded
+EVICTION_TARGET = 0.8
+
+# seconds between eviction passes of a process
+EVICTION_INTERVAL = 60 * 60
+
+# file in the shared folder holding the hit and miss counts
+STATS_FILE = ".stats.json"
+
+# eviction thread per shared folder
+_eviction_threads = {}
+_eviction_lock = threading.Lock()
+
+
+class CacheLocation(HookBaseClass):
+    """
+    Hook to control cache folder creation.
+    """
+
+    def get_bundle_data_cache_path(self, project_id, plugin_id, pipeline_configuration_id, bundle):
+        """
+        Establish a cache folder for an app, engine or framework.
+
+        Uses the default location, but for the bundles which download
+        thumbnails the ``thumbs`` sub folder is a link to the shared
+        thumbnail cache for the site.
+
+        :param project_id: The shotgun id of the project to store caches for, None if unspecified.
+        :param plugin_id: Unique string to identify the scope for a particular plugin
+                          or integration. For more information,
+                          see :meth:`~sgtk.bootstrap.ToolkitManager.plugin_id`. For
+                          non-plugin based toolkit projects, this value is None.
+        :param pipeline_configuration_id: The shotgun pipeline config id to store caches for
+        :param bundle: The app, engine or framework object which is requesting the cache folder.
+        :returns: The path to a folder which should exist on disk.
+        """
+        cache_path = super(CacheLocation, self).get_bundle_data_cache_path(
+            project_id,
+            plugin_id,
+            pipeline_configuration_id,
+            bundle
+        )
+
+        # windows symlinks need elevated privileges, so keep the default there
+        if bundle.name not in THUMBNAIL_BUNDLES or sys.platform == "win32":
+            return cache_path
+
+        shared_path = os.path.join(
+            LocalFileStorageManager.get_site_root(
+                self.parent.shotgun_url,
+                LocalFileStorageManager.CACHE
+            ),
+            "thumbs"
+        )
+
+        try:
+            ensure_folder_exists(shared_path)
+            _link_thumbnail_folder(os.path.join(cache_path, "thumbs"), shared_path)
+        except Exception as e:
+            # the bundle can still use its own thumbnail folder
+            self.logger.warning(
+                "Could not share thumbnail cache for %s: %s" % (bundle.name, e)
+            )
+            return cache_path
+
+        _start_eviction(shared_path, self.logger)
+
+        return cache_path
+
+
+def _link_thumbnail_folder(thumbs_path, shared_path):
+    """
+    Makes thumbs_path a symlink to shared_path. Thumbnails already in an
+    existing, unshared folder are moved into the shared cache.
+    """
+    if os.path.islink(thumbs_path):
+        if os.path.realpath(thumbs_path) == os.path.realpath(shared_path):
+            return
+        os.remove(thumbs_path)
+
+    old_path = None
+    if os.path.isdir(thumbs_path):
+        # move the folder aside first, so that a thumbnail written
+        # concurrently by another session never lands in a folder that is
+        # about to be deleted
+        old_path = "%s.%d.old" % (thumbs_path, os.getpid())
+        os.rename(thumbs_path, old_path)
+
+    try:
+        os.symlink(shared_path, thumbs_path)
+    except OSError as e:
+        # another session created the link at the same time
+        if e.errno != errno.EEXIST:
+            raise
+
+    if old_path:
+        for (dir_path, _, file_names) in os.walk(old_path):
+            target_dir = os.path.join(shared_path, os.path.relpath(dir_path, old_path))
+            for file_name in file_names:
+                target_path = os.path.join(target_dir, file_name)
+                if os.path.exists(target_path):
+                    continue
+                try:
+                    if not os.path.isdir(target_dir):
+                        os.makedirs(target_dir)
+                    os.rename(os.path.join(dir_path, file_name), target_path)
+                except OSError:
+                    pass
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def _start_eviction(shared_path, logger):
+    """
+    Starts a background thread which runs an eviction pass of the shared
+    cache right away and then every EVICTION_INTERVAL seconds, unless this
+    process started one already.
+    """
+    with _eviction_lock:
+        if shared_path in _eviction_threads:
+            return
+
+        thread = threading.Thread(
+            target=_evict_periodically,
+            args=(shared_path, logger)
+        )
+        thread.daemon = True
+        _eviction_threads[shared_path] = thread
+        thread.start()
+
+
+def _evict_periodically(shared_path, logger):
+    """
+    Runs eviction passes of the shared cache for the lifetime of the process.
+    """
+    while True:
+        try:
+            limit_mb = int(os.environ.get(THUMBNAIL_CACHE_SIZE_ENV_VAR, THUMBNAIL_CACHE_SIZE_DEFAULT))
+        except ValueError:
+            limit_mb = THUMBNAIL_CACHE_SIZE_DEFAULT
+
+        try:
+            _evict(shared_path, limit_mb * 1024 * 1024, logger)
+        except Exception as e:
+            # try again on the next pass
+            logger.debug("Thumbnail cache eviction of %s failed: %s" % (shared_path, e))
+
+        time.sleep(EVICTION_INTERVAL)
+
+
+def _evict(shared_path, limit, logger):
+    """
+    Removes the least recently used thumbnails until the cache is below the
+    eviction target. Only one process evicts at a time; the others skip.
+    """
+    lock_path = os.path.join(shared_path, ".evict.lock")
+    try:
+        lock_fh = open(lock_path, "a")
+    except IOError:
+        return
+
+    try:
+        import fcntl
+        fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock_fh.close()
+        return
+
+    try:
+        stats = get_thumbnail_cache_stats(shared_path)
+        last_pass = stats.get("last_pass")
+        now = time.time()
+        hits = 0
+        misses = 0
+
+        entries = []
+        total = 0
+        for (dir_path, _, file_names) in os.walk(shared_path):
+            for file_name in file_names:
+                if file_name.startswith("."):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # atime may be coarse (relatime) or disabled (noatime),
+                # in which case the download time is the best estimate
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+                total += stat.st_size
+
+                if last_pass is not None:
+                    if stat.st_mtime > last_pass:
+                        misses += 1
+                    elif stat.st_atime > last_pass:
+                        hits += 1
+
+        stats["last_pass"] = now
+        stats["hits"] = stats.get("hits", 0) + hits
+        stats["misses"] = stats.get("misses", 0) + misses
+        _save_stats(shared_path, stats)
+        logger.debug(
+            "Thumbnail cache %s: %d hits and %d misses since the last pass, "
+            "%d and %d in total."
+            % (shared_path, hits, misses, stats["hits"], stats["misses"])
+        )
+
+        if total <= limit:
+            return
+
+        target = limit * EVICTION_TARGET
+        evicted = 0
+        for (_, size, path) in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        logger.debug(
+            "Evicted %d thumbnails from %s, %d MB remain."
+            % (evicted, shared_path, total // (1024 * 1024))
+        )
+    finally:
+        lock_fh.close()
+
+
+def get_thumbnail_cache_stats(shared_path):
+    """
+    Returns the estimated hit and miss counts of a shared thumbnail cache.
+
+    :param str shared_path: Path to the shared thumbnail folder.
+    :returns: Dictionary with the total ``hits`` and ``misses`` recorded by
+        the eviction passes, and the time of the ``last_pass``. Empty if no
+        pass has run yet.
+    """
+    try:
+        with open(os.path.join(shared_path, STATS_FILE), "r") as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_stats(shared_path, stats):
+    """
+    Writes the hit and miss counts of a shared thumbnail cache.
+    """
+    stats_path = os.path.join(shared_path, STATS_FILE)
+    tmp_path = "%s.%d.tmp" % (stats_path, os.getpid())
+    try:
+        with open(tmp_path, "w") as fh:
+            json.dump(stats, fh)
+        os.rename(tmp_path, stats_path)
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,574 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Hook that gets executed every time a new Toolkit API instance is created.
+
+It installs two optional, environment variable controlled instruments. Neither
+touches the core unless its variable is set, so they cost nothing otherwise.
+
+When the TK_STARTUP_PROFILE environment variable is set to a folder, this hook
+instruments the parts of the core that load this configuration: parsing of
+each environment and include file, execution of each hook and loading and
+initialization of each app and framework. Every time an engine finishes
+starting up, two files named after the engine, environment and process are
+written to that folder:
+
+* a ``.txt`` report ranking every step by the total time spent in it
+* a ``.json`` trace in the Chrome trace event format, which can be opened as a
+  flame graph in chrome://tracing, Perfetto or speedscope
+
+When the TK_HOOK_METRICS environment variable is set, every call to a hook
+which lives in this configuration (core/hooks and hooks) is timed. This
+includes the collector and plugin methods of the publisher, which creates
+those hooks as instances rather than executing them through the core. Call
+counts, latency percentiles and samples of slow calls, together with the
+entity type, environment, engine or number of items involved, are aggregated
+per hook method and flushed every TK_HOOK_METRICS_INTERVAL seconds (default
+60) and when the application exits. The variable is either a file, to which a
+JSON line is appended per flush, or ``udp://host:port`` for a statsd server.
+Calls slower than TK_HOOK_METRICS_SLOW_MS milliseconds (default 50) are kept
+as samples.
+"""
+
+import atexit
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+from tank import Hook, LogManager
+
+logger = LogManager.get_logger(__name__)
+
+PROFILE_ENV_VAR = "TK_STARTUP_PROFILE"
+
+METRICS_ENV_VAR = "TK_HOOK_METRICS"
+METRICS_INTERVAL_ENV_VAR = "TK_HOOK_METRICS_INTERVAL"
+METRICS_SLOW_MS_ENV_VAR = "TK_HOOK_METRICS_SLOW_MS"
+
+
+class TankInit(Hook):
+
+    def execute(self, **kwargs):
+        """
+        Installs the startup profiler and hook metrics if they were requested.
+        """
+        profile_dir = os.environ.get(PROFILE_ENV_VAR)
+        metrics_sink = os.environ.get(METRICS_ENV_VAR)
+        if not profile_dir and not metrics_sink:
+            return
+
+        config_root = self.parent.pipeline_configuration.get_config_location()
+
+        if profile_dir:
+            StartupProfiler.install(profile_dir, config_root)
+
+        if metrics_sink:
+            HookMetrics.install(
+                metrics_sink,
+                config_root,
+                float(os.environ.get(METRICS_INTERVAL_ENV_VAR, 60)),
+                float(os.environ.get(METRICS_SLOW_MS_ENV_VAR, 50)) / 1000.0
+            )
+
+
+class StartupProfiler(object):
+    """
+    Records nested, timed spans and writes them out once an engine has started.
+
+    Spans are only recorded while an engine is starting: from the creation of
+    the Toolkit instance, the choice of an environment or the loading of one,
+    until the engine has been initialized and its report written. Calls made
+    once the engine runs are not recorded.
+    """
+
+    def __init__(self, profile_dir, config_root):
+        """
+        :param str profile_dir: Folder the profiles are written to.
+        :param str config_root: Root of the configuration, used to shorten the
+            paths of environment files in the report.
+        """
+        self._profile_dir = profile_dir
+        self._config_root = config_root
+        self._lock = threading.Lock()
+        self._spans = []
+        # the Toolkit instance which installs the profiler is created to
+        # start an engine
+        self._recording = True
+
+    @classmethod
+    def install(cls, profile_dir, config_root):
+        """
+        Instruments the core. This hook runs each time a Toolkit instance is
+        created, so only the first call installs anything.
+        """
+        import tank.hook
+
+        if getattr(tank.hook, "startup_profiler", None):
+            return
+
+        profiler = cls(profile_dir, config_root)
+        tank.hook.startup_profiler = profiler
+
+        from tank.util import yaml_cache
+        from tank.platform import application, engine, environment, framework
+
+        yaml_cache.g_yaml_cache.get = profiler._wrap(
+            yaml_cache.g_yaml_cache.get,
+            "yaml",
+            lambda path, *args, **kwargs: profiler._relative_path(path)
+        )
+
+        environment.Environment.__init__ = profiler._wrap(
+            environment.Environment.__init__,
+            "environment",
+            lambda env, env_path, *args, **kwargs: profiler._relative_path(env_path),
+            starts_recording=True
+        )
+
+        get_application = profiler._wrap(
+            application.get_application,
+            "app",
+            lambda *args, **kwargs: "load %s" % (kwargs.get("instance_name") or args[4],)
+        )
+
+        def profiled_get_application(*args, **kwargs):
+            app = get_application(*args, **kwargs)
+            # apps override init_app, so time the bound method on the instance
+            app.init_app = profiler._wrap(
+                app.init_app,
+                "app",
+                lambda: "init %s" % (app.instance_name,)
+            )
+            return app
+
+        application.get_application = profiled_get_application
+
+        framework.load_framework = profiler._wrap(
+            framework.load_framework,
+            "framework",
+            lambda engine_obj, env, fw_instance_name, *args, **kwargs: fw_instance_name
+        )
+
+        engine_init = profiler._wrap(
+            engine.Engine.__init__,
+            "engine",
+            lambda engine_obj, tk, context, engine_instance_name, *args, **kwargs: engine_instance_name,
+            starts_recording=True
+        )
+
+        def profiled_engine_init(engine_obj, *args, **kwargs):
+            try:
+                engine_init(engine_obj, *args, **kwargs)
+            finally:
+                # a broken report must not stop the engine from starting
+                try:
+                    profiler.write(engine_obj)
+                except Exception:
+                    logger.exception("Could not write the startup profile.")
+
+        engine.Engine.__init__ = profiled_engine_init
+
+        execute_hook_method = profiler._wrap(
+            tank.hook.execute_hook_method,
+            "hook",
+            lambda hook_paths, parent, method_name, *args, **kwargs: "%s.%s" % (
+                os.path.basename(hook_paths[-1]), method_name or "execute"
+            )
+        )
+
+        def profiled_execute_hook_method(hook_paths, *args, **kwargs):
+            # picking an environment is the first step of starting an engine
+            if os.path.basename(hook_paths[0]) == "pick_environment.py":
+                profiler.start()
+            return execute_hook_method(hook_paths, *args, **kwargs)
+
+        tank.hook.execute_hook_method = profiled_execute_hook_method
+
+    def start(self):
+        """
+        Starts recording spans, if not recording already.
+        """
+        with self._lock:
+            self._recording = True
+
+    def write(self, engine):
+        """
+        Writes the spans recorded so far for an engine and stops recording
+        until the next engine starts.
+
+        :param engine: Engine which just finished starting up.
+        """
+        with self._lock:
+            spans = self._spans
+            self._spans = []
+            self._recording = False
+
+        if not spans:
+            return
+
+        try:
+            env_name = engine.environment["name"]
+        except Exception:
+            env_name = "unknown"
+
+        base_name = os.path.join(
+            self._profile_dir,
+            "%s_%s_%d" % (engine.instance_name, env_name, os.getpid())
+        )
+
+        if not os.path.isdir(self._profile_dir):
+            os.makedirs(self._profile_dir)
+
+        start = min(span[2] for span in spans)
+
+        events = []
+        for (category, name, begin, end, thread_id) in spans:
+            events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": int((begin - start) * 1e6),
+                "dur": int((end - begin) * 1e6),
+                "pid": os.getpid(),
+                "tid": thread_id,
+            })
+
+        with open(base_name + ".json", "w") as fh:
+            json.dump({"traceEvents": events}, fh)
+
+        totals = {}
+        for (category, name, begin, end, thread_id) in spans:
+            (count, total) = totals.get((category, name), (0, 0.0))
+            totals[(category, name)] = (count + 1, total + end - begin)
+
+        ranked = sorted(totals.items(), key=lambda entry: entry[1][1], reverse=True)
+
+        with open(base_name + ".txt", "w") as fh:
+            fh.write(
+                "Startup profile for %s in environment %s\n\n"
+                % (engine.instance_name, env_name)
+            )
+            fh.write("%10s %6s  %-12s %s\n" % ("total ms", "calls", "category", "step"))
+            for ((category, name), (count, total)) in ranked:
+                fh.write("%10.1f %6d  %-12s %s\n" % (total * 1000, count, category, name))
+
+    def _wrap(self, func, category, get_name, starts_recording=False):
+        """
+        Returns a wrapper around a function which records a span for each call
+        made while recording.
+
+        :param func: Function to time.
+        :param str category: Category of the step, e.g. 'yaml' or 'hook'.
+        :param get_name: Callable receiving the same arguments as func and
+            returning the name of the step.
+        :param bool starts_recording: Whether a call to the function means an
+            engine is starting.
+        """
+        def wrapper(*args, **kwargs):
+            if starts_recording:
+                self.start()
+            elif not self._recording:
+                return func(*args, **kwargs)
+
+            try:
+                name = get_name(*args, **kwargs)
+            except Exception:
+                name = getattr(func, "__name__", repr(func))
+            begin = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end = time.time()
+                with self._lock:
+                    # spans finishing after the report was written are dropped
+                    if self._recording:
+                        self._spans.append(
+                            (category, name, begin, end, threading.current_thread().ident)
+                        )
+
+        wrapper.__name__ = getattr(func, "__name__", "wrapper")
+        wrapper.__doc__ = getattr(func, "__doc__", None)
+        return wrapper
+
+    def _relative_path(self, path):
+        """
+        Returns a path relative to the configuration if it lives inside it.
+        """
+        if path.startswith(self._config_root):
+            return os.path.relpath(path, self._config_root)
+        return path
+
+
+class HookMetrics(object):
+    """
+    Aggregates call counts, latencies and slow calls of the configuration's
+    hooks and periodically flushes them to a file or a statsd server.
+    """
+
+    # latencies kept per hook method to estimate its percentiles
+    RESERVOIR_SIZE = 1024
+
+    # slow calls kept per hook method between flushes
+    SLOW_SAMPLES = 10
+
+    # largest statsd packet sent, to stay below a typical MTU
+    STATSD_PACKET_SIZE = 1400
+
+    # methods timed on hook instances, i.e. the publisher's collector and
+    # plugins
+    INSTANCE_METHODS = (
+        "process_current_session",
+        "process_file",
+        "accept",
+        "validate",
+        "publish",
+        "finalize",
+    )
+
+    def __init__(self, sink, slow_threshold):
+        """
+        :param str sink: File path, or ``udp://host:port`` of a statsd server.
+        :param float slow_threshold: Seconds after which a call is sampled.
+        """
+        self._sink = sink
+        self._slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @classmethod
+    def install(cls, sink, config_root, interval, slow_threshold):
+        """
+        Instruments hook execution. This hook runs each time a Toolkit
+        instance is created, so only the first call installs anything.
+        """
+        import tank.hook
+
+        if getattr(tank.hook, "hook_metrics", None):
+            return
+
+        metrics = cls(sink, slow_threshold)
+        tank.hook.hook_metrics = metrics
+
+        def measure(hook_path, method_name, func, args, kwargs):
+            result = None
+            begin = time.time()
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                # metrics must never get in the way of the artist, so an
+                # error recording the call must not replace its outcome
+                try:
+                    metrics.record(
+                        "%s.%s" % (
+                            os.path.splitext(os.path.basename(hook_path))[0],
+                            method_name or "execute"
+                        ),
+                        time.time() - begin,
+                        kwargs,
+                        result
+                    )
+                except Exception:
+                    pass
+
+        execute_hook_method = tank.hook.execute_hook_method
+
+        def measured_execute_hook_method(hook_paths, parent, method_name, *args, **kwargs):
+            hook_path = hook_paths[-1]
+            # hooks shipped with the core and the apps are left alone
+            if not hook_path.startswith(config_root):
+                return execute_hook_method(hook_paths, parent, method_name, *args, **kwargs)
+
+            return measure(
+                hook_path,
+                method_name,
+                execute_hook_method,
+                (hook_paths, parent, method_name) + args,
+                kwargs
+            )
+
+        tank.hook.execute_hook_method = measured_execute_hook_method
+
+        # the publisher creates its collector and plugins as hook instances
+        # and calls their methods directly, bypassing execute_hook_method
+        create_hook_instance = tank.hook.create_hook_instance
+
+        def measured_create_hook_instance(hook_paths, *args, **kwargs):
+            instance = create_hook_instance(hook_paths, *args, **kwargs)
+            hook_path = hook_paths[-1]
+            if not hook_path.startswith(config_root):
+                return instance
+
+            def measured_method(method_name, method):
+                def wrapper(*args, **kwargs):
+                    return measure(hook_path, method_name, method, args, kwargs)
+                return wrapper
+
+            for method_name in cls.INSTANCE_METHODS:
+                method = getattr(instance, method_name, None)
+                if callable(method):
+                    setattr(instance, method_name, measured_method(method_name, method))
+            return instance
+
+        tank.hook.create_hook_instance = measured_create_hook_instance
+
+        thread = threading.Thread(target=metrics._flush_periodically, args=(interval,))
+        thread.daemon = True
+        thread.start()
+
+        atexit.register(metrics.flush)
+
+    def record(self, name, duration, kwargs, result):
+        """
+        Records a single hook call.
+
+        :param str name: Hook file and method, e.g. 'pick_environment.execute'.
+        :param float duration: Duration of the call in seconds.
+        :param dict kwargs: Arguments the hook was called with.
+        :param result: Value the hook returned.
+        """
+        sample = None
+        if duration >= self._slow_threshold:
+            sample = {
+                "ms": round(duration * 1000, 3),
+                "time": time.time(),
+                "context": _describe_call(kwargs, result),
+            }
+
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = {
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "latencies": [],
+                    "slow": [],
+                }
+
+            stats["count"] += 1
+            stats["total"] += duration
+            stats["max"] = max(stats["max"], duration)
+
+            # reservoir sampling keeps an unbiased set of latencies
+            latencies = stats["latencies"]
+            if len(latencies) < self.RESERVOIR_SIZE:
+                latencies.append(duration)
+            else:
+                index = random.randint(0, stats["count"] - 1)
+                if index < self.RESERVOIR_SIZE:
+                    latencies[index] = duration
+
+            if sample and len(stats["slow"]) < self.SLOW_SAMPLES:
+                stats["slow"].append(sample)
+
+    def flush(self):
+        """
+        Writes out the metrics gathered since the last flush and resets them.
+        """
+        with self._lock:
+            stats = self._stats
+            self._stats = {}
+
+        if not stats:
+            return
+
+        summary = {}
+        for (name, values) in stats.items():
+            latencies = sorted(values["latencies"])
+            summary[name] = {
+                "count": values["count"],
+                "mean_ms": values["total"] * 1000 / values["count"],
+                "p50_ms": _percentile(latencies, 0.5) * 1000,
+                "p90_ms": _percentile(latencies, 0.9) * 1000,
+                "p99_ms": _percentile(latencies, 0.99) * 1000,
+                "max_ms": values["max"] * 1000,
+                "slow": values["slow"],
+            }
+
+        try:
+            if self._sink.startswith("udp://"):
+                self._send_statsd(summary)
+            else:
+                with open(self._sink, "a") as fh:
+                    fh.write(json.dumps({
+                        "time": time.time(),
+                        "pid": os.getpid(),
+                        "hooks": summary,
+                    }) + "\n")
+        except Exception:
+            # metrics must never get in the way of the artist
+            pass
+
+    def _flush_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def _send_statsd(self, summary):
+        """
+        Sends the summary to a statsd server as counters and gauges.
+        """
+        (host, port) = self._sink[len("udp://"):].rsplit(":", 1)
+
+        lines = []
+        for (name, values) in summary.items():
+            prefix = "tk.hook.%s" % (name.replace(".", "_").replace("-", "_"),)
+            lines.append("%s.count:%d|c" % (prefix, values["count"]))
+            for key in ("mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"):
+                lines.append("%s.%s:%.3f|g" % (prefix, key, values[key]))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            packet = ""
+            for line in lines:
+                if packet and len(packet) + len(line) + 1 > self.STATSD_PACKET_SIZE:
+                    sock.sendto(packet.encode("utf-8"), (host, int(port)))
+                    packet = ""
+                packet = "%s\n%s" % (packet, line) if packet else line
+            if packet:
+                sock.sendto(packet.encode("utf-8"), (host, int(port)))
+        finally:
+            sock.close()
+
+
+def _percentile(values, fraction):
+    """
+    Returns a percentile of a sorted list of values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _describe_call(kwargs, result):
+    """
+    Returns the parts of a hook call worth keeping with a slow sample: the
+    entity type, engine, environment or number of items it dealt with.
+    """
+    context = {}
+    for key in ("entity_type", "engine_instance_name", "version_id", "preview_mode"):
+        if key in kwargs:
+            context[key] = kwargs[key]
+
+    if "items" in kwargs:
+        context["item_count"] = len(kwargs["items"])
+
+    if kwargs.get("context") is not None:
+        context["context"] = str(kwargs["context"])
+        # pick_environment returns the name of the environment it chose
+        if isinstance(result, str):
+            context["environment"] = result
+
+    return context
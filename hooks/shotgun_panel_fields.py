@@ -69,6 +69,42 @@ class ShotgunFields(HookBaseClass):
         :param entity_type: Shotgun entity type to provide a template for
         :returns: Dictionary containing template strings
         """
+        # return a copy, the shared definition must not be modified
+        return dict(_LIST_ITEM_DEFINITIONS.get(entity_type, _DEFAULT_LIST_ITEM_DEFINITION))
+
+    def get_all_fields(self, entity_type):
+        """
+        Define which fields should be displayed in the 'info' tab
+        for a given entity type. 
+        
+        :param entity_type: Shotgun entity type to provide a template for
+        :returns: List of Shotgun fields
+        """
+        # return a copy, callers may extend the list with fields of their own
+        return list(_ALL_FIELDS.get(entity_type, _DEFAULT_ALL_FIELDS))
+
+    def get_main_view_definition(self, entity_type):
+        """
+        Define which info is shown in the top-level detail section
+        for an item of a given entity type.
+        
+        Should return a dictionary with the following keys:
+        
+        - title: top level title string, displayed next to the 
+                 navigation buttons.
+        - body: content to display in the main info area
+        
+        :param entity_type: Shotgun entity type to provide a template for
+        :returns: Dictionary containing template strings
+        """
+        # return a copy, the shared definition must not be modified
+        return dict(_MAIN_VIEW_DEFINITIONS.get(entity_type, _DEFAULT_MAIN_VIEW_DEFINITION))
+
+    @staticmethod
+    def _build_list_item_definition(entity_type):
+        """
+        Builds the list item definition for an entity type.
+        """
         
         # define a set of defaults
         values = {
@@ -112,13 +148,10 @@ class ShotgunFields(HookBaseClass):
         return values
         
     
-    def get_all_fields(self, entity_type):
+    @staticmethod
+    def _build_all_fields(entity_type):
         """
-        Define which fields should be displayed in the 'info' tab
-        for a given entity type. 
-        
-        :param entity_type: Shotgun entity type to provide a template for
-        :returns: List of Shotgun fields
+        Builds the list of info fields for an entity type.
         """
         
         # supported by all normal fields
@@ -247,19 +280,10 @@ class ShotgunFields(HookBaseClass):
     
     
 
-    def get_main_view_definition(self, entity_type):
+    @staticmethod
+    def _build_main_view_definition(entity_type):
         """
-        Define which info is shown in the top-level detail section
-        for an item of a given entity type.
-        
-        Should return a dictionary with the following keys:
-        
-        - title: top level title string, displayed next to the 
-                 navigation buttons.
-        - body: content to display in the main info area
-        
-        :param entity_type: Shotgun entity type to provide a template for
-        :returns: Dictionary containing template strings
+        Builds the main view definition for an entity type.
         """
         
         values = {
@@ -385,3 +409,41 @@ class ShotgunFields(HookBaseClass):
 
         
     
+
+
+# The panel asks for these definitions every time it draws a widget, so they
+# are built once, when the hook is loaded, for every entity type the builders
+# special case. All other entity types share the default definitions.
+_ENTITY_TYPES = (
+    "ApiUser",
+    "Asset",
+    "ClientUser",
+    "Group",
+    "HumanUser",
+    "Note",
+    "Project",
+    "PublishedFile",
+    "ScriptUser",
+    "Sequence",
+    "Shot",
+    "Task",
+    "Version",
+)
+
+_LIST_ITEM_DEFINITIONS = dict(
+    (entity_type, ShotgunFields._build_list_item_definition(entity_type))
+    for entity_type in _ENTITY_TYPES
+)
+_DEFAULT_LIST_ITEM_DEFINITION = ShotgunFields._build_list_item_definition(None)
+
+_ALL_FIELDS = dict(
+    (entity_type, tuple(ShotgunFields._build_all_fields(entity_type)))
+    for entity_type in _ENTITY_TYPES
+)
+_DEFAULT_ALL_FIELDS = tuple(ShotgunFields._build_all_fields(None))
+
+_MAIN_VIEW_DEFINITIONS = dict(
+    (entity_type, ShotgunFields._build_main_view_definition(entity_type))
+    for entity_type in _ENTITY_TYPES
+)
+_DEFAULT_MAIN_VIEW_DEFINITION = ShotgunFields._build_main_view_definition(None)
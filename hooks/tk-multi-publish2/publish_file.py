@@ -0,0 +1,470 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Publish plugin which copies work files to their publish location in parallel
+and records an integrity manifest for the files it copies there.
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import sgtk
+from sgtk.util.filesystem import ensure_folder_exists
+
+HookBaseClass = sgtk.get_hook_baseclass()
+
+# linux ioctl request used to clone a file's extents on filesystems that
+# support reflinks (btrfs, xfs). Copying falls back to a byte copy elsewhere.
+FICLONE = 0x40049409
+
+# size of each chunk handed to copy_file_range
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# size of each slice of a mapped file handed to the hash. hashlib releases the
+# GIL while digesting, so worker threads hash frames concurrently.
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# frame tokens which are stripped from a sequence path to name its manifest
+FRAME_SPEC_REGEX = re.compile(r"[._]?(%0?\d*d|#+|@+|\$F\d*)(?=\.[^./\\]+$)")
+
+
+class MavericksPublishFilePlugin(HookBaseClass):
+    """
+    Extends the standard publish plugin so that work files are copied to the
+    publish area through a bounded pool of worker threads, and so that the
+    copied files are hashed into an integrity manifest.
+
+    Frame sequences such as ``nuke_shot_render_mono_exr`` ->
+    ``nuke_shot_render_pub_mono_exr`` are copied frame by frame in parallel.
+    Frames which already exist at the destination with the same size and
+    modification time are skipped, so an interrupted publish can simply be
+    run again.
+
+    Items published in place, without a publish template, get no manifest.
+    The manifest is written next to the published files, named after the
+    publish path with any frame token removed and a ``.sha1`` extension. It
+    uses the ``sha1sum`` format. Deliveries are checked with
+    ``scripts/verify_manifest.py``, or ``sha1sum -c`` on machines without
+    this configuration.
+    """
+
+    @property
+    def settings(self):
+        """
+        Adds the number of copy workers to the base plugin settings.
+        """
+        plugin_settings = super(MavericksPublishFilePlugin, self).settings or {}
+
+        plugin_settings["Copy Workers"] = {
+            "type": "int",
+            "default": 8,
+            "description": "Number of files copied concurrently when "
+                           "copying work files to the publish area, and "
+                           "files hashed concurrently for the manifest."
+        }
+
+        plugin_settings["Integrity Manifest"] = {
+            "type": "bool",
+            "default": True,
+            "description": "Write a checksum manifest next to the files "
+                           "copied to the publish area."
+        }
+
+        return plugin_settings
+
+    def publish(self, settings, item):
+        """
+        Executes the publish logic for the given item and settings, then
+        writes the integrity manifest for the published files.
+
+        :param settings: Dictionary of Settings. The keys are strings,
+            matching the keys returned in the settings property. The values
+            are `Setting` instances.
+        :param item: Item to process
+        """
+        super(MavericksPublishFilePlugin, self).publish(settings, item)
+
+        if "Integrity Manifest" in settings and \
+                not settings["Integrity Manifest"].value:
+            return
+
+        # only files copied to a publish template get a manifest. Items
+        # published in place would get one next to the artist's source file.
+        published_files = item.properties.get("published_files")
+        if not published_files:
+            return
+
+        publish_path = self.get_publish_path(settings, item)
+
+        # the publish is already registered in Shotgun at this point, so a
+        # manifest which cannot be written must not fail it
+        try:
+            self.write_manifest(
+                published_files,
+                get_manifest_path(publish_path),
+                self._get_workers(settings)
+            )
+        except Exception as e:
+            self.logger.warning(
+                "Could not write the integrity manifest for '%s': %s"
+                % (publish_path, e)
+            )
+
+    def write_manifest(self, paths, manifest_path, workers=8):
+        """
+        Hashes a list of files and writes them to a manifest.
+
+        :param paths: List of file paths to include.
+        :param str manifest_path: Path of the manifest to write. Files are
+            recorded relative to its folder.
+        :param int workers: Number of files to hash concurrently.
+        :returns: Path of the manifest.
+        :raises: Exception if any of the files could not be hashed.
+        """
+        results = _run_parallel(_hash_file, [(path,) for path in paths], workers)
+
+        manifest_folder = os.path.dirname(manifest_path)
+        lines = []
+        for ((path,), digest, error) in results:
+            if error:
+                raise Exception(
+                    "Failed to hash '%s' for manifest '%s': %s"
+                    % (path, manifest_path, error)
+                )
+            rel_path = os.path.relpath(path, manifest_folder).replace(os.sep, "/")
+            lines.append("%s  %s\n" % (digest, rel_path))
+
+        with open(manifest_path, "w") as fh:
+            fh.writelines(sorted(lines, key=lambda line: line[42:]))
+
+        self.logger.info(
+            "Wrote integrity manifest for %d files: %s" % (len(lines), manifest_path)
+        )
+        return manifest_path
+
+    def copy_sequence(self, work_template, publish_template, fields, workers=8):
+        """
+        Copies all files matching a work template to a publish template.
+
+        The work template is expanded over every frame found on disk, and each
+        frame is mapped onto the publish template using its own fields.
+
+        :param work_template: Template describing the work files.
+        :param publish_template: Template describing the publish files.
+        :param fields: Fields used to resolve both templates. Any frame
+            key (SEQ, flame.frame) is ignored and expanded from disk.
+        :param int workers: Number of files to copy concurrently.
+        :returns: List of publish paths which were written or already up to
+            date.
+        """
+        frame_keys = [key for key in work_template.keys
+                      if key in ("SEQ", "flame.frame")]
+        work_files = self.sgtk.paths_from_template(
+            work_template,
+            fields,
+            skip_keys=frame_keys
+        )
+
+        copies = []
+        for work_file in sorted(work_files):
+            work_fields = work_template.get_fields(work_file)
+            publish_fields = dict(fields)
+            publish_fields.update(work_fields)
+            copies.append(
+                (work_file, publish_template.apply_fields(publish_fields))
+            )
+
+        return self._copy_files_parallel(copies, workers)
+
+    def _copy_work_to_publish(self, settings, item):
+        """
+        Copies the item's work file(s) to the publish location.
+
+        This mirrors the base implementation, but all files are gathered up
+        front and then handed to a worker pool rather than being copied one
+        at a time.
+
+        :param settings: Dictionary of Settings. The keys are strings,
+            matching the keys returned in the settings property. The values
+            are `Setting` instances.
+        :param item: Item to process
+        """
+        work_template = item.properties.get("work_template")
+        if not work_template:
+            self.logger.debug(
+                "No work template set on the item. "
+                "Skipping copy file to publish location."
+            )
+            return
+
+        publish_template = self.get_publish_template(settings, item)
+        if not publish_template:
+            self.logger.debug(
+                "No publish template set on the item. "
+                "Skipping copying file to publish location."
+            )
+            return
+
+        work_files = [item.properties["path"]]
+        if "sequence_paths" in item.properties:
+            work_files = item.properties.get("sequence_paths", [])
+            if not work_files:
+                self.logger.warning(
+                    "Sequence publish without a list of files. Publishing "
+                    "the sequence path in place: %s" % (item.properties["path"],)
+                )
+                return
+
+        copies = []
+        for work_file in work_files:
+
+            if not work_template.validate(work_file):
+                self.logger.warning(
+                    "Work file '%s' did not match work template '%s'. "
+                    "Publishing in place." % (work_file, work_template)
+                )
+                return
+
+            work_fields = work_template.get_fields(work_file)
+            missing_keys = publish_template.missing_keys(work_fields)
+            if missing_keys:
+                self.logger.warning(
+                    "Work file '%s' missing keys required for the publish "
+                    "template: %s" % (work_file, missing_keys)
+                )
+                return
+
+            copies.append((work_file, publish_template.apply_fields(work_fields)))
+
+        item.properties["published_files"] = self._copy_files_parallel(
+            copies,
+            self._get_workers(settings)
+        )
+
+    def _get_workers(self, settings):
+        """
+        Returns the number of worker threads configured for the plugin.
+        """
+        if "Copy Workers" in settings:
+            return settings["Copy Workers"].value
+        return 8
+
+    def _copy_files_parallel(self, copies, workers):
+        """
+        Copies a list of files using a bounded pool of threads.
+
+        :param copies: List of (source, destination) path tuples.
+        :param int workers: Maximum number of concurrent copies.
+        :returns: List of destination paths.
+        :raises: Exception if any of the copies failed.
+        """
+        # create each destination folder once, up front, rather than
+        # from every worker thread
+        for folder in set(os.path.dirname(dst) for (_, dst) in copies):
+            ensure_folder_exists(folder)
+
+        results = _run_parallel(_copy_file, copies, workers)
+
+        errors = []
+        skipped = []
+        for ((src, dst), copied, error) in results:
+            if error:
+                errors.append((src, dst, error))
+            elif copied:
+                self.logger.debug(
+                    "Copied work file '%s' to publish file '%s'." % (src, dst)
+                )
+            else:
+                skipped.append(dst)
+
+        if skipped:
+            self.logger.info(
+                "%d of %d files were already up to date in the publish area."
+                % (len(skipped), len(copies))
+            )
+
+        if errors:
+            (src, dst, e) = errors[0]
+            raise Exception(
+                "Failed to copy %d of %d files to the publish area. First "
+                "failure: '%s' to '%s': %s" % (len(errors), len(copies), src, dst, e)
+            )
+
+        return [dst for (_, dst) in copies]
+
+
+def _run_parallel(func, jobs, workers):
+    """
+    Calls a function for each job using a bounded pool of threads.
+
+    :param func: Callable taking the job's items as positional arguments.
+    :param jobs: List of argument tuples, one per call.
+    :param int workers: Maximum number of concurrent calls.
+    :returns: List of (job, result, exception) tuples in the order of jobs.
+        Exactly one of result and exception is set for each job.
+    """
+    pending = queue.Queue()
+    for (index, job) in enumerate(jobs):
+        pending.put((index, job))
+
+    results = [None] * len(jobs)
+
+    def worker():
+        while True:
+            try:
+                (index, job) = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = (job, func(*job), None)
+            except Exception as e:
+                results[index] = (job, None, e)
+
+    threads = []
+    for _ in range(max(1, min(workers, len(jobs)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def get_manifest_path(publish_path):
+    """
+    Returns the path of the integrity manifest for a publish path.
+
+    ``/pub/plate.%04d.exr`` becomes ``/pub/plate.exr.sha1`` and
+    ``/pub/comp_v003.nk`` becomes ``/pub/comp_v003.nk.sha1``.
+    """
+    return FRAME_SPEC_REGEX.sub("", publish_path) + ".sha1"
+
+
+def _hash_file(path):
+    """
+    Returns the hex sha1 digest of a file, reading it through a memory map.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # slicing a view hands the mapped pages to the hash without
+                # copying them. Python 2 maps cannot be viewed, slicing the
+                # map itself copies each chunk.
+                try:
+                    view = memoryview(mapped)
+                except TypeError:
+                    view = None
+                try:
+                    data = mapped if view is None else view
+                    for offset in range(0, size, HASH_CHUNK_SIZE):
+                        digest.update(data[offset:offset + HASH_CHUNK_SIZE])
+                finally:
+                    # the map cannot be closed while a view of it is alive
+                    if view is not None:
+                        view.release()
+            finally:
+                mapped.close()
+    return digest.hexdigest()
+
+
+def _copy_file(src, dst):
+    """
+    Copies a single file, preserving its modification time.
+
+    The data is written to a temporary file next to the destination which is
+    renamed into place once complete, so a partial frame is never mistaken
+    for a finished one.
+
+    :returns: False if the destination was already up to date, True otherwise.
+    """
+    src_stat = os.stat(src)
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        dst_stat = None
+
+    if (dst_stat is not None and
+            dst_stat.st_size == src_stat.st_size and
+            int(dst_stat.st_mtime) == int(src_stat.st_mtime)):
+        return False
+
+    tmp_dst = "%s.%d.part" % (dst, os.getpid())
+    try:
+        with open(src, "rb") as src_fh:
+            with open(tmp_dst, "wb") as dst_fh:
+                _copy_data(src_fh, dst_fh, src_stat.st_size)
+        shutil.copystat(src, tmp_dst)
+        os.chmod(tmp_dst, 0o666)
+        if dst_stat is not None and os.name == "nt":
+            # rename does not replace existing files on windows
+            os.remove(dst)
+        os.rename(tmp_dst, dst)
+    except Exception:
+        if os.path.exists(tmp_dst):
+            os.remove(tmp_dst)
+        raise
+
+    return True
+
+
+def _copy_data(src_fh, dst_fh, size):
+    """
+    Copies the contents of one open file to another, using the fastest
+    mechanism available: a reflink clone, then an in-kernel copy and
+    finally a plain buffered copy.
+    """
+    try:
+        import fcntl
+        fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+        return
+    except (ImportError, IOError, OSError):
+        pass
+
+    if hasattr(os, "copy_file_range"):
+        offset = 0
+        try:
+            while offset < size:
+                copied = os.copy_file_range(
+                    src_fh.fileno(),
+                    dst_fh.fileno(),
+                    min(COPY_CHUNK_SIZE, size - offset)
+                )
+                if copied == 0:
+                    break
+                offset += copied
+            if offset >= size:
+                return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP):
+                raise
+        # start again from scratch with a buffered copy
+        src_fh.seek(0)
+        dst_fh.seek(0)
+        dst_fh.truncate()
+
+    shutil.copyfileobj(src_fh, dst_fh, 1024 * 1024)
@@ -0,0 +1,413 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Upload for review plugin which hands the media upload to a persistent
+background queue instead of blocking the publish.
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+import sgtk
+from sgtk.util import LocalFileStorageManager
+
+HookBaseClass = sgtk.get_hook_baseclass()
+
+# the Version field holding the uploaded movie, the only upload queued
+MOVIE_FIELD = "sg_uploaded_movie"
+
+# job states recorded in the journal
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class MavericksUploadVersionPlugin(HookBaseClass):
+    """
+    Extends the standard upload plugin so that the Version is created as
+    usual, but the movie itself is recorded in a local journal and uploaded
+    by background workers.
+
+    The artist gets control back as soon as the Version exists. Jobs that
+    are still pending when the application exits are picked up by the next
+    session that publishes on the same site.
+    """
+
+    @property
+    def settings(self):
+        """
+        Adds the background upload settings to the base plugin settings.
+        """
+        plugin_settings = super(MavericksUploadVersionPlugin, self).settings or {}
+
+        plugin_settings["Background Upload"] = {
+            "type": "bool",
+            "default": True,
+            "description": "Queue the media upload and return immediately "
+                           "instead of waiting for it to complete."
+        }
+
+        plugin_settings["Upload Workers"] = {
+            "type": "int",
+            "default": 2,
+            "description": "Number of uploads run concurrently by the "
+                           "background queue."
+        }
+
+        return plugin_settings
+
+    def publish(self, settings, item):
+        """
+        Creates the Version for the item and queues its media upload.
+
+        :param settings: Dictionary of Settings. The keys are strings,
+            matching the keys returned in the settings property. The values
+            are `Setting` instances.
+        :param item: Item to process
+        """
+        if "Background Upload" in settings and \
+                not settings["Background Upload"].value:
+            super(MavericksUploadVersionPlugin, self).publish(settings, item)
+            return
+
+        workers = 2
+        if "Upload Workers" in settings:
+            workers = settings["Upload Workers"].value
+        upload_queue = get_upload_queue(self.parent, workers)
+
+        # the base implementation creates the Version and then uploads the
+        # media inline through the connection's upload method. Intercept that
+        # call for the duration of the publish and journal it instead. The
+        # thumbnail uploads go through the same method, often from a temporary
+        # file which is gone by the time a worker would run, so everything
+        # but the movie is passed on.
+        shotgun = self.parent.shotgun
+        upload = shotgun.upload
+
+        def queue_upload(entity_type, entity_id, path, field_name=None,
+                         display_name=None, tag_list=None):
+            if field_name != MOVIE_FIELD:
+                return upload(entity_type, entity_id, path, field_name,
+                              display_name, tag_list)
+            job_id = upload_queue.submit(entity_type, entity_id, path,
+                                         field_name, display_name)
+            self.logger.info("Queued %s for background upload." % (path,))
+            return job_id
+
+        shotgun.upload = queue_upload
+        try:
+            super(MavericksUploadVersionPlugin, self).publish(settings, item)
+        finally:
+            del shotgun.upload
+
+
+# one queue per process, shared by every publish in the session
+_upload_queue = None
+_upload_queue_lock = threading.Lock()
+
+
+def get_upload_queue(app, workers=2):
+    """
+    Returns the upload queue for this process, creating it on first use.
+
+    :param app: App used to locate the site cache and to connect to Shotgun.
+    :param int workers: Number of upload threads to run.
+    """
+    global _upload_queue
+    with _upload_queue_lock:
+        if _upload_queue is None:
+            site_root = LocalFileStorageManager.get_site_root(
+                app.sgtk.shotgun_url,
+                LocalFileStorageManager.CACHE
+            )
+            if not os.path.isdir(site_root):
+                os.makedirs(site_root)
+            _upload_queue = UploadQueue(
+                os.path.join(site_root, "upload_queue.db"),
+                lambda: app.sgtk.shotgun,
+                app.logger,
+                workers
+            )
+            _upload_queue.start()
+        return _upload_queue
+
+
+class UploadQueue(object):
+    """
+    Journal backed queue of Shotgun uploads.
+
+    Each job is a row in a sqlite database in the user's site cache, so
+    several DCC sessions on the same workstation share one journal. A job is
+    leased by a worker while it runs; if the session dies mid-upload the lease
+    expires and another session picks the job up again.
+    """
+
+    # seconds a running job is reserved for the worker that claimed it. The
+    # lease is renewed every LEASE_RENEWAL seconds while the upload runs, so
+    # it only expires when the session running the upload has died.
+    LEASE = 10 * 60
+    LEASE_RENEWAL = 60
+
+    # retry delays grow from BACKOFF seconds, doubling up to BACKOFF_MAX
+    BACKOFF = 10
+    BACKOFF_MAX = 30 * 60
+    MAX_ATTEMPTS = 8
+
+    # seconds an idle worker sleeps before polling the journal again
+    POLL_INTERVAL = 5
+
+    def __init__(self, journal_path, connect, logger, workers=2):
+        """
+        :param str journal_path: Path to the sqlite journal.
+        :param connect: Callable returning a Shotgun connection for the
+            calling thread. Any object with a shotgun_api3 compatible
+            ``upload`` method can be returned.
+        :param logger: Logger for progress and errors.
+        :param int workers: Number of upload threads.
+        """
+        self._journal_path = journal_path
+        self._connect = connect
+        self._logger = logger
+        self._workers = workers
+        self._threads = []
+        self._wake = threading.Event()
+        self._stopped = False
+
+        with self._open() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY, "
+                "entity_type TEXT, entity_id INTEGER, "
+                "path TEXT, field_name TEXT, display_name TEXT, "
+                "size INTEGER, mtime INTEGER, "
+                "state TEXT, attempts INTEGER DEFAULT 0, "
+                "run_after REAL DEFAULT 0, error TEXT)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, run_after)"
+            )
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        for _ in range(max(1, self._workers)):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the worker threads once their current upload, if any, is done.
+        Jobs left in the journal are picked up by the next queue started.
+        """
+        self._stopped = True
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, entity_type, entity_id, path, field_name=None,
+               display_name=None):
+        """
+        Records an upload in the journal and returns immediately.
+
+        A request for the same file on the same entity field is only recorded
+        once while it is queued, and is skipped entirely if that exact file
+        has already been uploaded.
+
+        :returns: Id of the journal entry handling the upload.
+        """
+        stat = os.stat(path)
+        key = (entity_type, entity_id, path, field_name)
+
+        with self._open() as db:
+            row = db.execute(
+                "SELECT id, state, size, mtime FROM jobs "
+                "WHERE entity_type=? AND entity_id=? AND path=? "
+                "AND field_name IS ? AND state != ? ORDER BY id DESC",
+                key + (FAILED,)
+            ).fetchone()
+
+            if row is not None:
+                (job_id, state, size, mtime) = row
+                if state != DONE or (size, mtime) == (stat.st_size, int(stat.st_mtime)):
+                    self._logger.debug("Upload of %s already queued as job %d." % (path, job_id))
+                    return job_id
+
+            cursor = db.execute(
+                "INSERT INTO jobs (entity_type, entity_id, path, field_name, "
+                "display_name, size, mtime, state) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                key + (display_name, stat.st_size, int(stat.st_mtime), PENDING)
+            )
+            job_id = cursor.lastrowid
+
+        self._wake.set()
+        return job_id
+
+    def pending(self):
+        """
+        Returns the number of jobs which have not completed or failed yet.
+        """
+        with self._open() as db:
+            return db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)",
+                (PENDING, RUNNING)
+            ).fetchone()[0]
+
+    @contextlib.contextmanager
+    def _open(self):
+        """
+        Opens a connection to the journal for a single transaction. sqlite
+        connections cannot be shared between threads, so each operation
+        uses its own.
+        """
+        db = sqlite3.connect(self._journal_path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _claim(self):
+        """
+        Leases the next runnable job to the calling worker.
+
+        :returns: Job row as a tuple, or None if nothing is runnable.
+        """
+        now = time.time()
+        with self._open() as db:
+            row = db.execute(
+                "SELECT id, entity_type, entity_id, path, field_name, "
+                "display_name, attempts, run_after FROM jobs "
+                "WHERE (state=? OR state=?) AND run_after <= ? "
+                "ORDER BY id LIMIT 1",
+                (PENDING, RUNNING, now)
+            ).fetchone()
+            if row is None:
+                return None
+            # only take the job if no other worker or session leased it
+            # between the select and the update
+            claimed = db.execute(
+                "UPDATE jobs SET state=?, run_after=? WHERE id=? AND run_after=?",
+                (RUNNING, now + self.LEASE, row[0], row[7])
+            ).rowcount
+        if not claimed:
+            return None
+        return row[:7]
+
+    def _finish(self, job_id, state, run_after=0, error=None, attempts=None):
+        """
+        Records the outcome of a job.
+        """
+        with self._open() as db:
+            db.execute(
+                "UPDATE jobs SET state=?, run_after=?, error=?, "
+                "attempts=COALESCE(?, attempts) WHERE id=?",
+                (state, run_after, error, attempts, job_id)
+            )
+
+    def _renew(self, job_id):
+        """
+        Extends the lease of a running job.
+        """
+        with self._open() as db:
+            db.execute(
+                "UPDATE jobs SET run_after=? WHERE id=? AND state=?",
+                (time.time() + self.LEASE, job_id, RUNNING)
+            )
+
+    def _keep_leased(self, job_id, done):
+        """
+        Renews the lease of a job until the done event is set, so that an
+        upload which runs longer than the lease is not claimed again by
+        another worker or session.
+        """
+        while not done.wait(self.LEASE_RENEWAL):
+            try:
+                self._renew(job_id)
+            except sqlite3.Error as e:
+                self._logger.warning(
+                    "Could not renew the lease of upload job %d: %s" % (job_id, e)
+                )
+
+    def _run(self):
+        """
+        Worker loop: claims jobs from the journal and uploads them, retrying
+        failures with exponential backoff.
+        """
+        while not self._stopped:
+            try:
+                processed = self._process_next()
+            except Exception as e:
+                # most likely the journal is locked by another session. The
+                # job, if any, is retried once its lease expires.
+                self._logger.warning("Upload journal unavailable: %s" % (e,))
+                processed = False
+
+            if not processed:
+                self._wake.wait(self.POLL_INTERVAL)
+                self._wake.clear()
+
+    def _process_next(self):
+        """
+        Claims and uploads a single job.
+
+        :returns: False if there was no runnable job, True otherwise.
+        """
+        job = self._claim()
+        if job is None:
+            return False
+
+        (job_id, entity_type, entity_id, path, field_name, display_name, attempts) = job
+
+        done = threading.Event()
+        renewer = threading.Thread(target=self._keep_leased, args=(job_id, done))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            try:
+                self._connect().upload(
+                    entity_type,
+                    entity_id,
+                    path,
+                    field_name=field_name,
+                    display_name=display_name
+                )
+            finally:
+                done.set()
+                renewer.join()
+        except Exception as e:
+            attempts += 1
+            if attempts >= self.MAX_ATTEMPTS or not os.path.exists(path):
+                self._logger.error(
+                    "Giving up on upload of %s to %s %d: %s"
+                    % (path, entity_type, entity_id, e)
+                )
+                self._finish(job_id, FAILED, error=str(e), attempts=attempts)
+            else:
+                delay = min(self.BACKOFF * 2 ** (attempts - 1), self.BACKOFF_MAX)
+                self._logger.warning(
+                    "Upload of %s failed, retrying in %ds: %s" % (path, delay, e)
+                )
+                self._finish(job_id, PENDING, time.time() + delay, str(e), attempts)
+        else:
+            self._logger.info(
+                "Uploaded %s to %s %d." % (path, entity_type, entity_id)
+            )
+            self._finish(job_id, DONE)
+
+        return True
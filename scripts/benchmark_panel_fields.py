@@ -0,0 +1,133 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Benchmarks the Shotgun panel field hook over simulated panel refreshes.
+
+A refresh asks the hook for the list item definition of every Note and
+Version in the panel's listings, and for the main view definition and the
+info fields of each of them, as the panel does when it draws the listing and
+then shows an item. No Shotgun data is involved, only the hook is timed::
+
+    python benchmark_panel_fields.py
+    python benchmark_panel_fields.py --notes 5000 --versions 5000 --refreshes 50
+
+To compare against another version of the hook, pass a hook file or a git
+revision of this configuration with --compare. For instance, the hook before
+the commit which precomputed the definitions::
+
+    python benchmark_panel_fields.py --compare "$(git log -1 --format=%H \
+        --grep='Precompute the Shotgun panel field definitions')~1"
+    python benchmark_panel_fields.py --compare /tmp/shotgun_panel_fields.py
+
+The core of a pipeline configuration needs to be on the PYTHONPATH; the hook
+is loaded through the core's hook loader.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from tank import hook
+
+CONFIG_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOOK_PATH = os.path.join(CONFIG_ROOT, "hooks", "shotgun_panel_fields.py")
+
+
+def refresh(fields_hook, entity_types):
+    """
+    Asks the hook for everything the panel needs to draw a listing of
+    entities and show each of them.
+
+    :param fields_hook: Shotgun panel fields hook instance.
+    :param entity_types: Entity type of each entity in the listing.
+    """
+    for entity_type in entity_types:
+        fields_hook.get_list_item_definition(entity_type)
+    for entity_type in entity_types:
+        fields_hook.get_main_view_definition(entity_type)
+        fields_hook.get_all_fields(entity_type)
+
+
+def benchmark(hook_path, entity_types, refreshes):
+    """
+    Times a number of refreshes with a hook.
+
+    :returns: List of the duration of each refresh, in seconds.
+    """
+    fields_hook = hook.create_hook_instance([hook_path], None)
+
+    durations = []
+    for _ in range(refreshes):
+        begin = time.time()
+        refresh(fields_hook, entity_types)
+        durations.append(time.time() - begin)
+    return durations
+
+
+def extract_hook(revision, folder):
+    """
+    Writes the hook as of a git revision of this configuration to a folder.
+
+    :param str revision: Any revision git understands, e.g. a commit or HEAD~2.
+    :param str folder: Folder to write the hook to.
+    :returns: Path to the extracted hook.
+    """
+    rel_path = os.path.relpath(HOOK_PATH, CONFIG_ROOT).replace(os.sep, "/")
+    content = subprocess.check_output(
+        ["git", "show", "%s:%s" % (revision, rel_path)],
+        cwd=CONFIG_ROOT
+    )
+    hook_path = os.path.join(folder, os.path.basename(HOOK_PATH))
+    with open(hook_path, "wb") as fh:
+        fh.write(content)
+    return hook_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--notes", type=int, default=2000, help="Notes in the listing.")
+    parser.add_argument("--versions", type=int, default=2000, help="Versions in the listing.")
+    parser.add_argument("--refreshes", type=int, default=20, help="Number of refreshes timed.")
+    parser.add_argument("--compare", metavar="HOOK_OR_REVISION",
+                        help="Another version of the hook to time: a file, or a git revision "
+                             "of this configuration to take the hook from.")
+    args = parser.parse_args(argv)
+
+    entity_types = ["Note"] * args.notes + ["Version"] * args.versions
+
+    hooks = [(HOOK_PATH, HOOK_PATH)]
+    folder = tempfile.mkdtemp()
+    try:
+        if args.compare:
+            if os.path.isfile(args.compare):
+                hooks.append((os.path.abspath(args.compare), args.compare))
+            else:
+                try:
+                    hooks.append((extract_hook(args.compare, folder), "%s at %s" % (HOOK_PATH, args.compare)))
+                except (OSError, subprocess.CalledProcessError) as e:
+                    parser.error("'%s' is neither a hook file nor a git revision: %s" % (args.compare, e))
+
+        print("%d refreshes of %d Notes and %d Versions" % (args.refreshes, args.notes, args.versions))
+        for (hook_path, label) in hooks:
+            durations = sorted(benchmark(hook_path, entity_types, args.refreshes))
+            print(
+                "%8.2f ms median %8.2f ms min  %s"
+                % (durations[len(durations) // 2] * 1000, durations[0] * 1000, label)
+            )
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
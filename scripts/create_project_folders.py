@@ -0,0 +1,464 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Creates the folders for a whole project in one pass.
+
+The entity folders of core/schema are not created with their parent, so
+creating folders for the Project only creates its static folders. The
+folders of each Sequence, Shot and Asset have to be created for that entity,
+and the core then resolves its parents and steps with several Shotgun
+queries per entity: one to read it and its parents, one per shotgun_entity
+level above it and one for its Steps.
+
+This script first reads every Sequence, Shot, Asset, Step and Task of the
+project with a handful of paged queries. It then runs the regular folder
+creation once per entity type for all entities of that type, i.e. three
+calls to the core and to the process_folder_creation hook, with the core's
+Shotgun connection answering the per-entity queries from the records already
+in memory. Queries it cannot answer are passed through to Shotgun, so the
+folders created are the same as with tank folders::
+
+    python create_project_folders.py 123
+    python create_project_folders.py 123 --preview
+
+The core of the project's pipeline configuration needs to be on the
+PYTHONPATH.
+"""
+
+import argparse
+import sys
+
+import sgtk
+from sgtk.authentication import ShotgunAuthenticator
+
+# records returned per query when reading the project
+PAGE_SIZE = 500
+
+# fields read up front for each entity type, enough for the filters and
+# folder names used by core/schema
+PREFETCH_FIELDS = {
+    "Project": ["name", "tank_name"],
+    "Sequence": ["code", "project", "description", "sg_status_list"],
+    "Shot": ["code", "project", "sg_sequence", "description", "sg_status_list"],
+    "Asset": ["code", "project", "sg_asset_type", "description", "sg_status_list"],
+    "Step": ["code", "short_name", "entity_type"],
+    "Task": ["content", "project", "entity", "step", "sg_status_list"],
+}
+
+# entity types whose folders are created, parents first
+FOLDER_ENTITY_TYPES = ["Sequence", "Shot", "Asset"]
+
+
+class UnsupportedQuery(Exception):
+    """
+    Raised when a query cannot be answered from the prefetched records.
+    """
+
+
+class PrefetchedShotgun(object):
+    """
+    Shotgun connection which answers simple finds from records in memory.
+
+    Finds on the prefetched entity types whose filters and fields only use
+    prefetched fields are evaluated locally. Everything else, including all
+    writes, goes to the wrapped connection.
+    """
+
+    def __init__(self, sg, records):
+        """
+        :param sg: Shotgun connection to fall back to.
+        :param dict records: Mapping of entity type to a dictionary of
+            records keyed by id.
+        """
+        self._sg = sg
+        self._records = records
+        self._indexes = {}
+        self.local_queries = 0
+        self.remote_queries = 0
+
+    def __getattr__(self, name):
+        return getattr(self._sg, name)
+
+    def find(self, entity_type, filters, fields=None, order=None,
+             filter_operator=None, limit=0, retired_only=False, page=0,
+             **kwargs):
+        try:
+            if entity_type not in self._records or retired_only or page or kwargs:
+                raise UnsupportedQuery()
+            if isinstance(filters, dict):
+                condition = filters
+            else:
+                condition = {"filter_operator": filter_operator or "all", "filters": filters}
+
+            fields = ["type", "id"] + [field for field in (fields or []) if field not in ("type", "id")]
+            results = []
+            for record in self._candidates(entity_type, condition):
+                if self._match(record, condition):
+                    results.append(
+                        dict((field, self._resolve(record, field)) for field in fields)
+                    )
+
+            results.sort(key=lambda result: result["id"])
+            for order_item in reversed(order or []):
+                field = order_item["field_name"]
+                try:
+                    results.sort(
+                        key=lambda result: self._resolve(self._records[entity_type][result["id"]], field),
+                        reverse=order_item.get("direction") == "desc"
+                    )
+                except TypeError:
+                    # values which do not compare locally, e.g. entity links
+                    raise UnsupportedQuery()
+
+        except UnsupportedQuery:
+            self.remote_queries += 1
+            return self._sg.find(entity_type, filters, fields, order, filter_operator,
+                                 limit, retired_only, page, **kwargs)
+
+        self.local_queries += 1
+        if limit:
+            results = results[:limit]
+        return results
+
+    def find_one(self, entity_type, filters, fields=None, order=None,
+                 filter_operator=None, retired_only=False, **kwargs):
+        results = self.find(entity_type, filters, fields, order, filter_operator,
+                            1, retired_only, **kwargs)
+        if results:
+            return results[0]
+        return None
+
+    def _candidates(self, entity_type, condition):
+        """
+        Returns the records which may match a condition.
+
+        The core queries each entity, its parents and its Steps separately,
+        so scanning all records for each query would grow with the square of
+        the project size. An "is" condition at the top of an "and" group on
+        the id, on a prefetched field or on the Tasks of a Step is looked up
+        directly or in an index instead.
+        """
+        (operator, conditions) = _split_group(condition)
+        if operator in ("all", "and"):
+            for sub in conditions:
+                sub = _to_list(sub)
+                if not isinstance(sub, (list, tuple)) or len(sub) != 3 or sub[1] != "is":
+                    continue
+                (field, _, value) = sub
+
+                if field == "id":
+                    record = self._records[entity_type].get(value)
+                    if record is None:
+                        # not part of the project, Shotgun may still know it
+                        raise UnsupportedQuery()
+                    return [record]
+
+                key = _index_key(value)
+                if key is None:
+                    continue
+
+                if field.startswith("$FROM$"):
+                    try:
+                        (from_type, link_field, from_field) = self._parse_from(field)
+                    except UnsupportedQuery:
+                        continue
+                    candidates = {}
+                    for linking in self._index(from_type, from_field).get(key, []):
+                        link = linking.get(link_field)
+                        if link and link.get("type") == entity_type and link["id"] in self._records[entity_type]:
+                            candidates[link["id"]] = self._records[entity_type][link["id"]]
+                    return candidates.values()
+
+                if field in PREFETCH_FIELDS.get(entity_type, []):
+                    return self._index(entity_type, field).get(key, [])
+
+        return self._records[entity_type].values()
+
+    def _index(self, entity_type, field):
+        """
+        Returns the records of an entity type keyed by the value of a field,
+        building the index on first use.
+        """
+        index = self._indexes.get((entity_type, field))
+        if index is None:
+            index = {}
+            for record in self._records[entity_type].values():
+                record_key = _index_key(record.get(field))
+                if record_key is not None:
+                    index.setdefault(record_key, []).append(record)
+            self._indexes[(entity_type, field)] = index
+        return index
+
+    def _parse_from(self, field):
+        """
+        Splits a ``$FROM$Task.step.entity`` path, which the core's step
+        folders use to find the Steps which have a Task on an entity, into
+        the (entity type, link field, field) it refers to.
+        """
+        parts = field[len("$FROM$"):].split(".")
+        if len(parts) != 3 or parts[0] not in self._records:
+            raise UnsupportedQuery()
+        (from_type, link_field, from_field) = parts
+        if link_field not in PREFETCH_FIELDS[from_type] or from_field not in PREFETCH_FIELDS[from_type]:
+            raise UnsupportedQuery()
+        return (from_type, link_field, from_field)
+
+    def _resolve(self, record, field):
+        """
+        Returns the value of a field, following deep links such as
+        ``sg_sequence.Sequence.code``.
+        """
+        if field in ("type", "id"):
+            return record[field]
+
+        parts = field.split(".")
+        if len(parts) == 1:
+            if field not in record:
+                raise UnsupportedQuery()
+            return record[field]
+
+        if len(parts) % 2 == 0:
+            raise UnsupportedQuery()
+
+        value = self._resolve(record, parts[0])
+        if value is None:
+            return None
+        if parts[1] not in self._records:
+            raise UnsupportedQuery()
+        if value.get("type") != parts[1]:
+            return None
+        linked = self._records[parts[1]].get(value["id"])
+        if linked is None:
+            # linked to something outside of the project
+            raise UnsupportedQuery()
+        return self._resolve(linked, ".".join(parts[2:]))
+
+    def _match(self, record, condition):
+        """
+        Evaluates a filter condition against a record.
+        """
+        condition = _to_list(condition)
+
+        if isinstance(condition, dict):
+            (operator, conditions) = _split_group(condition)
+            if operator is None:
+                raise UnsupportedQuery()
+            matches = [self._match(record, sub) for sub in conditions]
+            if operator in ("all", "and"):
+                return all(matches)
+            if operator in ("any", "or"):
+                return any(matches)
+            raise UnsupportedQuery()
+
+        (field, relation) = condition[:2]
+        values = list(condition[2:])
+        if len(values) == 1 and isinstance(values[0], (list, tuple)):
+            values = list(values[0])
+
+        if field.startswith("$FROM$"):
+            if relation != "is" or len(values) != 1:
+                raise UnsupportedQuery()
+            (from_type, link_field, from_field) = self._parse_from(field)
+            return any(
+                _equal(linking.get(link_field), record)
+                for linking in self._index(from_type, from_field).get(_index_key(values[0]), [])
+            )
+
+        value = self._resolve(record, field)
+
+        if relation == "is":
+            return _equal(value, values[0] if values else None)
+        if relation == "is_not":
+            return not _equal(value, values[0] if values else None)
+        if relation == "in":
+            return any(_equal(value, candidate) for candidate in values)
+        if relation == "not_in":
+            return not any(_equal(value, candidate) for candidate in values)
+        if relation == "type_is":
+            return value is not None and value.get("type") == values[0]
+        raise UnsupportedQuery()
+
+
+def _equal(value, other):
+    """
+    Compares two field values, treating entity links as equal when their
+    type and id match.
+    """
+    if isinstance(value, dict) and isinstance(other, dict):
+        return value.get("type") == other.get("type") and value.get("id") == other.get("id")
+    return value == other
+
+
+def _split_group(condition):
+    """
+    Returns the (operator, conditions) of a filter group, or (None, []) if
+    the condition is not a group. The folder code sends
+    {"logical_operator", "conditions"}, the api also accepts
+    {"filter_operator", "filters"}.
+    """
+    if "conditions" in condition:
+        return (condition.get("logical_operator", "and"), condition["conditions"])
+    if "filters" in condition:
+        return (condition.get("filter_operator", "all"), condition["filters"])
+    return (None, [])
+
+
+def _to_list(condition):
+    """
+    Converts a {"path", "relation", "values"} condition to the
+    [path, relation, value, ...] form. Other conditions are returned as is.
+    """
+    if isinstance(condition, dict) and "path" in condition:
+        return [condition["path"], condition["relation"]] + list(condition["values"])
+    return condition
+
+
+def _index_key(value):
+    """
+    Returns the key of a field value in an index, or None for values which
+    are not indexed.
+    """
+    if isinstance(value, dict):
+        if "type" in value and "id" in value:
+            return (value["type"], value["id"])
+        return None
+    if value is None or isinstance(value, (list, tuple, set)):
+        return None
+    return value
+
+
+def prefetch(sg, project):
+    """
+    Reads every prefetched entity type of a project with paged queries.
+
+    :param sg: Shotgun connection.
+    :param dict project: Project entity link.
+    :returns: Mapping of entity type to a dictionary of records keyed by id.
+    """
+    records = {}
+    for (entity_type, fields) in PREFETCH_FIELDS.items():
+        if entity_type == "Project":
+            filters = [["id", "is", project["id"]]]
+        elif entity_type == "Step":
+            filters = []
+        else:
+            filters = [["project", "is", project]]
+
+        records[entity_type] = {}
+        page = 1
+        while True:
+            results = sg.find(
+                entity_type,
+                filters,
+                fields,
+                order=[{"field_name": "id", "direction": "asc"}],
+                limit=PAGE_SIZE,
+                page=page
+            )
+            for result in results:
+                records[entity_type][result["id"]] = result
+            if len(results) < PAGE_SIZE:
+                break
+            page += 1
+
+    return records
+
+
+def create_project_folders(tk, project_id, preview=False, log=None):
+    """
+    Creates (or previews) the folders for a whole project.
+
+    :param tk: Toolkit instance for the project.
+    :param int project_id: Id of the project.
+    :param bool preview: Only list the folders which would be created.
+    :param log: Optional callable taking a progress message.
+    :returns: List of paths created, or which would be created.
+    """
+    log = log or (lambda message: None)
+
+    from sgtk.util.shotgun import connection
+
+    sg = tk.shotgun
+    records = prefetch(sg, {"type": "Project", "id": project_id})
+    log(
+        "Read %s." % ", ".join(
+            "%d %s" % (len(entities), entity_type)
+            for (entity_type, entities) in sorted(records.items())
+        )
+    )
+
+    # the folder code uses the connection cached for this thread, so swap
+    # the prefetched one in for the duration of the folder creation. This
+    # relies on the private thread local behind get_sg_connection() in
+    # tank/util/shotgun/connection.py of tk-core v0.18.148, the version
+    # pinned in core/core_api.yml. Check it still exists when updating core;
+    # tests/test_create_project_folders.py covers it.
+    cached = connection._g_sg_cached_connections
+    original = getattr(cached, "sg", None)
+    prefetched = PrefetchedShotgun(sg, records)
+    cached.sg = prefetched
+    paths = []
+    try:
+        if tk.shotgun is not prefetched:
+            log("This core does not use the cached connection, all folder queries go to Shotgun.")
+        for entity_type in FOLDER_ENTITY_TYPES:
+            entity_ids = sorted(records[entity_type])
+            if not entity_ids:
+                continue
+            if preview:
+                paths.extend(tk.preview_filesystem_structure(entity_type, entity_ids))
+            else:
+                paths.extend(tk.create_filesystem_structure(entity_type, entity_ids))
+    finally:
+        cached.sg = original
+
+    log(
+        "Answered %d folder queries from memory, %d went to Shotgun."
+        % (prefetched.local_queries, prefetched.remote_queries)
+    )
+
+    # the folders of the project and of each parent are listed by every
+    # call which goes through them
+    unique_paths = []
+    seen = set()
+    for path in paths:
+        if path not in seen:
+            seen.add(path)
+            unique_paths.append(path)
+    return unique_paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("project_id", type=int, help="Shotgun id of the project.")
+    parser.add_argument("--preview", action="store_true",
+                        help="List the folders which would be created.")
+    args = parser.parse_args(argv)
+
+    sgtk.set_authenticated_user(ShotgunAuthenticator().get_user())
+    tk = sgtk.sgtk_from_entity("Project", args.project_id)
+
+    paths = create_project_folders(
+        tk,
+        args.project_id,
+        args.preview,
+        lambda message: sys.stderr.write(message + "\n")
+    )
+
+    for path in sorted(paths):
+        print(path)
+    sys.stderr.write(
+        "%d folders %s.\n" % (len(paths), "would be created" if args.preview else "created")
+    )
+
+
+if __name__ == "__main__":
+    main()
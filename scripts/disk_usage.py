@@ -0,0 +1,478 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Disk usage accounting for a project built from this configuration.
+
+Walks a project root in parallel and attributes the bytes in every folder to
+the Sequence, Shot, Asset, Step, DCC and template the folder belongs to, as
+resolved from core/templates.yml. Folders the schema creates as symlinks into
+the cache trees (houdini sim, maya data, renders, ...) are followed and
+counted against the location of the link.
+
+Each run saves a snapshot of the walk. The next run only lists folders whose
+modification time has changed since that snapshot and reuses the recorded
+sizes and attribution for the rest. Snapshots record a hash of
+core/templates.yml and core/schema; when either changed, every folder is
+listed and attributed again. Comparing against an older snapshot reports
+growth::
+
+    python disk_usage.py /mnt/proj/abc --by Sequence,dcc,template
+    python disk_usage.py /mnt/proj/abc --by Sequence,dcc --compare 7
+
+Only the newest --keep snapshots (default 30) are kept, which bounds how far
+back --compare can reach.
+
+The project must be reachable through Toolkit, i.e. the core of the project's
+pipeline configuration needs to be on the PYTHONPATH.
+
+Only changes to a folder's entries (files created, removed or renamed) update
+its modification time. A file rewritten in place with a new size is picked up
+the next time its folder changes, or on a run with --full.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+import sgtk
+
+# dcc folders created by the schema under each step's work and publish areas
+DCC_FOLDERS = set([
+    "3DCoat",
+    "3dsmax",
+    "houdini",
+    "mari",
+    "maya",
+    "mobu",
+    "nuke",
+    "photoshop",
+    "speedtree",
+    "substance",
+    "zBrush",
+])
+
+# fields used to attribute usage, in report order
+ENTITY_FIELDS = ["Sequence", "Shot", "sg_asset_type", "Asset", "Step"]
+DIMENSIONS = ENTITY_FIELDS + ["dcc", "template"]
+
+SNAPSHOT_FOLDER = ".disk_usage"
+SNAPSHOT_KEEP_DEFAULT = 30
+
+
+class DiskUsageWalker(object):
+    """
+    Parallel, incremental walk of a project folder.
+
+    The result of a walk is a dictionary keyed by the logical path of each
+    folder, holding its modification time, the size and number of the files
+    directly inside it, its sub folders and the attribution of its files.
+    """
+
+    def __init__(self, tk, project_root, previous=None, workers=16):
+        """
+        :param tk: Toolkit instance for the project.
+        :param str project_root: Folder to walk.
+        :param dict previous: Folder records of the previous walk, if any.
+        :param int workers: Number of folders listed concurrently.
+        """
+        self._tk = tk
+        self._project_root = project_root
+        self._previous = previous or {}
+        self._workers = workers
+        self._folders = {}
+        self._lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._seen_targets = set()
+        self.listed = 0
+        # (path, error) of folders which could not be listed or attributed
+        self.failed = []
+
+        # templates pointing at folders rather than files, used to attribute
+        # folders which hold no file matching a template
+        self._folder_templates = [
+            template for template in tk.templates.values()
+            if "." not in os.path.basename(template.definition)
+        ]
+
+    def walk(self):
+        """
+        Walks the project and returns the folder records.
+        """
+        root = self._project_root
+        # resolve the root like the link targets, so that a cache folder
+        # reached directly and through a schema link has one real path even
+        # when the project sits behind a symlinked mount
+        real_root = os.path.realpath(root)
+        self._seen_targets.add(real_root)
+        self._jobs.put((root, real_root, {}, False))
+
+        for _ in range(self._workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+        self._jobs.join()
+        return self._folders
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                self._visit(*job)
+            except Exception as e:
+                # the folder vanished or is unreadable, count it as empty.
+                # Any error must be caught here: a worker which dies leaves
+                # its jobs unfinished and the walk would never return.
+                self._fail(job[0], e)
+            finally:
+                self._jobs.task_done()
+
+    def _visit(self, path, real_path, parent_key, linked):
+        """
+        Records a single folder and queues its sub folders.
+
+        :param str path: Logical path of the folder, through any symlink.
+        :param str real_path: Path the folder actually lives at.
+        :param dict parent_key: Attribution of the parent folder.
+        :param bool linked: True if the folder was reached through a symlink.
+        """
+        mtime = os.stat(real_path).st_mtime
+        record = self._previous.get(path)
+
+        if record is None or record["mtime"] != mtime or record["real_path"] != real_path:
+            record = self._list(path, real_path, mtime, parent_key)
+            with self._lock:
+                self.listed += 1
+
+        record["linked"] = linked
+        with self._lock:
+            self._folders[path] = record
+
+        for name in record["folders"]:
+            self._jobs.put(
+                (os.path.join(path, name), os.path.join(real_path, name), record["key"], linked)
+            )
+
+        for (name, target) in record["links"]:
+            # a target reached twice (e.g. two links to the same cache) is
+            # only counted against the first link walked
+            with self._lock:
+                if target in self._seen_targets:
+                    continue
+                self._seen_targets.add(target)
+            self._jobs.put((os.path.join(path, name), target, record["key"], True))
+
+    def _list(self, path, real_path, mtime, parent_key):
+        """
+        Lists a folder and returns its record.
+        """
+        size = 0
+        count = 0
+        sample = None
+        folders = []
+        links = []
+
+        for entry in scandir(real_path):
+            if entry.is_symlink():
+                target = os.path.realpath(entry.path)
+                if os.path.isdir(target):
+                    links.append((entry.name, target))
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.name)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+                count += 1
+                sample = sample or entry.name
+
+        try:
+            key = self._attribute(path, sample, parent_key)
+        except Exception as e:
+            # e.g. a path matching several templates. Count the folder
+            # against its parent's attribution and carry on below it.
+            self._fail(path, e)
+            key = dict(parent_key)
+
+        return {
+            "mtime": mtime,
+            "real_path": real_path,
+            "size": size,
+            "count": count,
+            "folders": folders,
+            "links": links,
+            "key": key,
+        }
+
+    def _fail(self, path, error):
+        """
+        Records a folder which could not be listed or attributed.
+        """
+        with self._lock:
+            self.failed.append((path, error))
+
+    def _attribute(self, path, sample, parent_key):
+        """
+        Works out which entities, dcc and template a folder belongs to.
+
+        One file of the folder is matched against the templates; frames of a
+        sequence and versions of a work file share a folder, so one match is
+        representative. Folders without a matching file inherit from their
+        parent, refined by any folder template they match.
+        """
+        key = dict(parent_key)
+
+        template = None
+        if sample:
+            match_path = os.path.join(path, sample)
+            template = self._tk.template_from_path(match_path)
+        if template is None:
+            match_path = path
+            for folder_template in self._folder_templates:
+                if folder_template.validate(path):
+                    template = folder_template
+                    break
+
+        if template is not None:
+            key["template"] = template.name
+            fields = template.get_fields(match_path)
+            for field in ENTITY_FIELDS:
+                if field in fields:
+                    key[field] = fields[field]
+
+        if "dcc" not in key:
+            name = os.path.basename(path)
+            if name in DCC_FOLDERS:
+                key["dcc"] = name
+
+        return key
+
+
+def summarize(folders, dimensions):
+    """
+    Totals folder sizes per combination of the given dimensions.
+
+    :returns: Dictionary mapping a tuple of dimension values to a
+        (bytes, files) tuple.
+    """
+    # a cache folder is reached both directly and through the schema symlink
+    # pointing at it. Count it once, against the location of the link.
+    records = {}
+    for (path, record) in folders.items():
+        # snapshots written before links were flagged only differ in path
+        linked = record.get("linked", path != record["real_path"])
+        current = records.get(record["real_path"])
+        if current is None or (linked and not current[0]):
+            records[record["real_path"]] = (linked, record)
+
+    totals = {}
+    for (_, record) in records.values():
+        group = tuple(record["key"].get(dimension, "-") for dimension in dimensions)
+        (size, count) = totals.get(group, (0, 0))
+        totals[group] = (size + record["size"], count + record["count"])
+    return totals
+
+
+def format_size(size):
+    """
+    Returns a human readable size, e.g. '4.0 TB'.
+    """
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(size) < 1024 or unit == "TB":
+            break
+        size /= 1024.0
+    return "%.1f %s" % (size, unit)
+
+
+def load_snapshot(path):
+    with gzip.open(path, "rb") as fh:
+        return json.loads(fh.read().decode("utf-8"))
+
+
+def save_snapshot(path, snapshot):
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wb") as fh:
+        fh.write(json.dumps(snapshot).encode("utf-8"))
+    os.rename(tmp_path, path)
+
+
+def config_hash(tk):
+    """
+    Returns a hash of the templates and the folder schema of a project's
+    configuration, which the attribution of folders is derived from.
+    """
+    pipeline_config = tk.pipeline_configuration
+    digest = hashlib.sha1()
+
+    templates_path = os.path.join(pipeline_config.get_config_location(), "core", "templates.yml")
+    with open(templates_path, "rb") as fh:
+        digest.update(fh.read())
+
+    schema_root = pipeline_config.get_schema_config_location()
+    for (dir_path, dir_names, file_names) in os.walk(schema_root):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            path = os.path.join(dir_path, file_name)
+            digest.update(os.path.relpath(path, schema_root).replace(os.sep, "/").encode("utf-8"))
+            with open(path, "rb") as fh:
+                digest.update(fh.read())
+
+    return digest.hexdigest()
+
+
+def prune_snapshots(snapshot_dir, keep):
+    """
+    Removes all but the newest snapshots.
+
+    :param int keep: Number of snapshots to keep. 0 keeps them all.
+    """
+    if keep <= 0:
+        return
+    for path in list_snapshots(snapshot_dir)[:-keep]:
+        try:
+            os.remove(path)
+        except OSError as e:
+            sys.stderr.write("Could not remove snapshot %s: %s\n" % (path, e))
+
+
+def list_snapshots(snapshot_dir):
+    """
+    Returns the paths of saved snapshots, oldest first.
+    """
+    if not os.path.isdir(snapshot_dir):
+        return []
+    return [
+        os.path.join(snapshot_dir, name)
+        for name in sorted(os.listdir(snapshot_dir))
+        if name.endswith(".json.gz")
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("project_root", help="Project folder to account for.")
+    parser.add_argument(
+        "--by",
+        default="Sequence,Shot,Step,dcc",
+        help="Comma separated dimensions to group by. Any of: %s" % ", ".join(DIMENSIONS)
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="DAYS_OR_SNAPSHOT",
+        help="Report growth against the newest snapshot at least this many "
+             "days old, or against a given snapshot file."
+    )
+    parser.add_argument("--snapshots", help="Folder to keep snapshots in. "
+                        "Defaults to %s inside the project root." % SNAPSHOT_FOLDER)
+    parser.add_argument("--workers", type=int, default=16,
+                        help="Number of folders listed concurrently.")
+    parser.add_argument("--full", action="store_true",
+                        help="Ignore the previous snapshot and list every folder.")
+    parser.add_argument("--keep", type=int, default=SNAPSHOT_KEEP_DEFAULT,
+                        help="Number of snapshots to keep, 0 to keep them all. "
+                             "Defaults to %d." % SNAPSHOT_KEEP_DEFAULT)
+    parser.add_argument("--limit", type=int, default=50, help="Number of rows to print.")
+    args = parser.parse_args(argv)
+
+    dimensions = [dimension.strip() for dimension in args.by.split(",")]
+    for dimension in dimensions:
+        if dimension not in DIMENSIONS:
+            parser.error("Unknown dimension '%s'" % dimension)
+
+    project_root = os.path.abspath(args.project_root)
+    snapshot_dir = args.snapshots or os.path.join(project_root, SNAPSHOT_FOLDER)
+    snapshots = list_snapshots(snapshot_dir)
+
+    tk = sgtk.sgtk_from_path(project_root)
+    current_hash = config_hash(tk)
+
+    previous = {}
+    if snapshots and not args.full:
+        snapshot = load_snapshot(snapshots[-1])
+        # the recorded attribution is stale once the templates or schema change
+        if snapshot.get("config_hash") == current_hash:
+            previous = snapshot["folders"]
+        else:
+            sys.stderr.write("Templates or schema changed since the last snapshot, listing every folder.\n")
+
+    walker = DiskUsageWalker(tk, project_root, previous, args.workers)
+
+    start = time.time()
+    folders = walker.walk()
+    folders.pop(snapshot_dir, None)
+    sys.stderr.write(
+        "Walked %d folders in %.1fs, listed %d changed ones.\n"
+        % (len(folders), time.time() - start, walker.listed)
+    )
+    for (path, error) in sorted(walker.failed, key=lambda failure: failure[0]):
+        sys.stderr.write("Failed on %s: %s\n" % (path, error))
+
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    now = time.time()
+    save_snapshot(
+        os.path.join(snapshot_dir, time.strftime("%Y%m%d-%H%M%S.json.gz", time.localtime(now))),
+        {"time": now, "config_hash": current_hash, "folders": folders}
+    )
+
+    totals = summarize(folders, dimensions)
+
+    baseline = None
+    if args.compare:
+        if os.path.isfile(args.compare):
+            baseline = load_snapshot(args.compare)
+        else:
+            cutoff = now - float(args.compare) * 24 * 60 * 60
+            for path in reversed(snapshots):
+                snapshot = load_snapshot(path)
+                if snapshot["time"] <= cutoff:
+                    baseline = snapshot
+                    break
+            if baseline is None:
+                parser.error("No snapshot older than %s days" % args.compare)
+
+    rows = []
+    if baseline is None:
+        for (group, (size, count)) in totals.items():
+            rows.append((size, group, "%12s %10d" % (format_size(size), count)))
+        header = "%12s %10s" % ("size", "files")
+    else:
+        old_totals = summarize(baseline["folders"], dimensions)
+        for group in set(totals) | set(old_totals):
+            size = totals.get(group, (0, 0))[0]
+            growth = size - old_totals.get(group, (0, 0))[0]
+            rows.append((growth, group, "%12s %12s" % (format_size(size), format_size(growth))))
+        header = "%12s %12s" % ("size", "growth")
+
+    print("%s  %s" % (header, "  ".join(dimensions)))
+    for (_, group, columns) in sorted(rows, key=lambda row: row[0], reverse=True)[:args.limit]:
+        print("%s  %s" % (columns, "  ".join(str(value) for value in group)))
+
+    # after the comparison, which may need the oldest snapshot
+    prune_snapshots(snapshot_dir, args.keep)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Checks published or delivered files against their integrity manifests.
+
+The publish plugin writes a ``.sha1`` manifest next to the files it copies to
+the publish area, e.g. ``plate.exr.sha1`` for ``plate.%04d.exr``. This script
+hashes the files listed in one or more manifests in parallel and lists every
+file which is missing or whose content changed, e.g. after a transfer to or
+from deliveries/to_mavericks::
+
+    python verify_manifest.py /mnt/proj/abc/deliveries/to_mavericks/*/*.sha1
+
+It exits with a non-zero status if any file does not match. Neither Toolkit
+nor a Shotgun connection is needed.
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# size of each slice of a mapped file handed to the hash. hashlib releases the
+# GIL while digesting, so worker threads hash files concurrently.
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def read_manifest(manifest_path):
+    """
+    Reads a manifest.
+
+    :param str manifest_path: Path to a manifest in the ``sha1sum`` format.
+    :returns: Dictionary mapping the path of each listed file to its hex
+        sha1 digest.
+    """
+    manifest_folder = os.path.dirname(os.path.abspath(manifest_path))
+
+    expected = {}
+    with open(manifest_path, "r") as fh:
+        for line in fh:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            (digest, rel_path) = line.split("  ", 1)
+            path = os.path.join(manifest_folder, *rel_path.split("/"))
+            expected[path] = digest
+    return expected
+
+
+def verify_manifest(manifest_path, workers=8):
+    """
+    Checks the files listed in a manifest against their recorded hashes.
+
+    :param str manifest_path: Path to a manifest.
+    :param int workers: Number of files to hash concurrently.
+    :returns: Tuple of sorted (mismatched, missing) lists of file paths. Both
+        are empty if the files on disk match the manifest.
+    """
+    expected = read_manifest(manifest_path)
+
+    missing = set(path for path in expected if not os.path.isfile(path))
+    present = sorted(path for path in expected if path not in missing)
+
+    mismatched = []
+    results = run_parallel(hash_file, [(path,) for path in present], workers)
+    for ((path,), digest, error) in results:
+        if error:
+            missing.add(path)
+        elif digest != expected[path]:
+            mismatched.append(path)
+
+    return (sorted(mismatched), sorted(missing))
+
+
+def hash_file(path):
+    """
+    Returns the hex sha1 digest of a file, reading it through a memory map.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size:
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # slicing a view hands the mapped pages to the hash without
+                # copying them. Python 2 maps cannot be viewed, slicing the
+                # map itself copies each chunk.
+                try:
+                    view = memoryview(mapped)
+                except TypeError:
+                    view = None
+                try:
+                    data = mapped if view is None else view
+                    for offset in range(0, size, HASH_CHUNK_SIZE):
+                        digest.update(data[offset:offset + HASH_CHUNK_SIZE])
+                finally:
+                    # the map cannot be closed while a view of it is alive
+                    if view is not None:
+                        view.release()
+            finally:
+                mapped.close()
+    return digest.hexdigest()
+
+
+def run_parallel(func, jobs, workers):
+    """
+    Calls a function for each job using a bounded pool of threads.
+
+    :param func: Callable taking the job's items as positional arguments.
+    :param jobs: List of argument tuples, one per call.
+    :param int workers: Maximum number of concurrent calls.
+    :returns: List of (job, result, exception) tuples in the order of jobs.
+        Exactly one of result and exception is set for each job.
+    """
+    pending = queue.Queue()
+    for (index, job) in enumerate(jobs):
+        pending.put((index, job))
+
+    results = [None] * len(jobs)
+
+    def worker():
+        while True:
+            try:
+                (index, job) = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = (job, func(*job), None)
+            except Exception as e:
+                results[index] = (job, None, e)
+
+    threads = []
+    for _ in range(max(1, min(workers, len(jobs)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("manifests", nargs="+", metavar="manifest", help="Manifest to check.")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Number of files hashed concurrently.")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for manifest_path in args.manifests:
+        try:
+            (mismatched, missing) = verify_manifest(manifest_path, args.workers)
+        except (IOError, OSError, ValueError) as e:
+            print("%s: unreadable manifest: %s" % (manifest_path, e))
+            failed = True
+            continue
+
+        for path in mismatched:
+            print("%s: MISMATCH %s" % (manifest_path, path))
+        for path in missing:
+            print("%s: MISSING %s" % (manifest_path, path))
+
+        if mismatched or missing:
+            failed = True
+            sys.stderr.write(
+                "%s: %d mismatched and %d missing files\n"
+                % (manifest_path, len(mismatched), len(missing))
+            )
+        else:
+            sys.stderr.write("%s: OK\n" % manifest_path)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
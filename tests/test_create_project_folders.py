@@ -0,0 +1,254 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for scripts/create_project_folders.py.
+
+The folders are previewed by the real folder creation of the core, for a
+throwaway pipeline configuration made of this configuration's core/schema and
+core/templates.yml and a temporary storage root. Shotgun is replaced by a
+fake connection which only answers the paged prefetch queries, so any query
+the prefetched connection passes through is recorded and creates no folders.
+
+The core of the project's pipeline configuration needs to be on the
+PYTHONPATH: the tests go through its folder creation, its default core hooks
+and its connection cache.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import tank
+    from tank import pipelineconfig
+    from tank.errors import TankFileDoesNotExistError
+    from tank_vendor import yaml
+    from sgtk.util.shotgun import connection
+except ImportError:
+    raise unittest.SkipTest("tk-core needs to be on the PYTHONPATH")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+import create_project_folders
+
+PROJECT = {"type": "Project", "id": 65}
+
+SHOT_STEPS = ["anim", "comp"]
+ASSET_STEPS = ["model", "rig"]
+ASSET_TYPES = ["Character", "Prop", "Environment"]
+
+
+def make_records(sequences, shots_per_sequence, assets):
+    """
+    Returns the records of a project, keyed by entity type.
+    """
+    records = dict((entity_type, []) for entity_type in create_project_folders.PREFETCH_FIELDS)
+    ids = iter(range(1000, 1000000))
+
+    def add(record_type, **fields):
+        record = dict(fields, type=record_type, id=next(ids))
+        records[record_type].append(record)
+        return {"type": record_type, "id": record["id"]}
+
+    records["Project"].append(dict(PROJECT, name="Test", tank_name="test"))
+
+    steps = {}
+    for (entity_type, names) in (("Shot", SHOT_STEPS), ("Asset", ASSET_STEPS)):
+        for name in names:
+            steps[name] = add("Step", code=name.title(), short_name=name, entity_type=entity_type)
+
+    for sequence_index in range(sequences):
+        sequence = add("Sequence", code="sq%03d" % sequence_index, project=PROJECT,
+                       description=None, sg_status_list="ip")
+        for shot_index in range(shots_per_sequence):
+            shot = add("Shot", code="sq%03d_sh%03d" % (sequence_index, shot_index), project=PROJECT,
+                       sg_sequence=sequence, description=None, sg_status_list="ip")
+            for step in SHOT_STEPS:
+                add("Task", content=step, project=PROJECT, entity=shot, step=steps[step],
+                    sg_status_list="wtg")
+
+    for asset_index in range(assets):
+        asset = add("Asset", code="asset%03d" % asset_index, project=PROJECT,
+                    sg_asset_type=ASSET_TYPES[asset_index % len(ASSET_TYPES)],
+                    description=None, sg_status_list="ip")
+        for step in ASSET_STEPS:
+            add("Task", content=step, project=PROJECT, entity=asset, step=steps[step],
+                sg_status_list="wtg")
+
+    return records
+
+
+class FakeShotgun(object):
+    """
+    Shotgun connection which only answers paged finds on simple filters.
+    """
+
+    def __init__(self, records):
+        self._records = records
+        self.page_queries = []
+        self.passed_through = []
+
+    def find(self, entity_type, filters, fields=None, order=None,
+             filter_operator=None, limit=0, retired_only=False, page=0,
+             **kwargs):
+        if not page:
+            self.passed_through.append((entity_type, filters))
+            return []
+
+        self.page_queries.append((entity_type, filters, page))
+        results = [
+            record for record in sorted(self._records[entity_type], key=lambda record: record["id"])
+            if all(self._equal(record.get(field), value) for (field, _, value) in filters)
+        ]
+        results = results[(page - 1) * limit:page * limit]
+        return [
+            dict((field, record.get(field)) for field in ["type", "id"] + list(fields))
+            for record in results
+        ]
+
+    def schema_field_read(self, entity_type, field_name=None):
+        return {field_name: {"properties": {"valid_values": {"value": ASSET_TYPES}}}}
+
+    @staticmethod
+    def _equal(value, other):
+        if isinstance(value, dict):
+            return value["type"] == other["type"] and value["id"] == other["id"]
+        return value == other
+
+
+def make_pipeline_configuration(folder):
+    """
+    Writes a pipeline configuration for the test project into a folder and
+    returns its project root. It uses this configuration's schema and
+    templates, the core's default hooks and a path cache in the project.
+    """
+    core_folder = os.path.join(folder, "config", "core")
+    os.makedirs(core_folder)
+    shutil.copytree(os.path.join(ROOT, "core", "schema"), os.path.join(core_folder, "schema"))
+    shutil.copy(os.path.join(ROOT, "core", "templates.yml"), core_folder)
+
+    storage_root = os.path.join(folder, "projects")
+    with open(os.path.join(core_folder, "roots.yml"), "w") as fh:
+        yaml.safe_dump({
+            "primary": {
+                "linux_path": storage_root,
+                "mac_path": storage_root,
+                "windows_path": storage_root,
+                "default": True,
+            }
+        }, fh)
+
+    with open(os.path.join(core_folder, "pipeline_configuration.yml"), "w") as fh:
+        yaml.safe_dump({
+            "project_name": "test",
+            "project_id": PROJECT["id"],
+            "pc_id": 1,
+            "pc_name": "Primary",
+            "use_shotgun_path_cache": False,
+        }, fh)
+
+    project_root = os.path.join(storage_root, "test")
+    os.makedirs(os.path.join(project_root, "tank", "cache"))
+    return project_root
+
+
+class TestCreateProjectFolders(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._folder = tempfile.mkdtemp()
+        cls.project_root = make_pipeline_configuration(cls._folder)
+        try:
+            cls.tk = tank.Tank(pipelineconfig.PipelineConfiguration(cls._folder))
+        except TankFileDoesNotExistError as e:
+            # e.g. a core installed without its default hooks
+            shutil.rmtree(cls._folder)
+            raise unittest.SkipTest("The core cannot run a configuration: %s" % e)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._folder)
+
+    def setUp(self):
+        self._original = getattr(connection._g_sg_cached_connections, "sg", None)
+
+    def tearDown(self):
+        connection._g_sg_cached_connections.sg = self._original
+
+    def _create(self, sequences, shots_per_sequence, assets):
+        sg = FakeShotgun(make_records(sequences, shots_per_sequence, assets))
+        connection._g_sg_cached_connections.sg = sg
+        paths = create_project_folders.create_project_folders(self.tk, PROJECT["id"], preview=True)
+        return (sg, paths)
+
+    def _folders(self, paths, *pattern):
+        """
+        Returns the folders below the project root whose path has as many
+        levels as the pattern and starts with its non-None levels.
+        """
+        folders = []
+        for path in paths:
+            levels = os.path.relpath(path, self.project_root).split(os.sep)
+            if len(levels) == len(pattern) and all(
+                expected is None or expected == level for (expected, level) in zip(pattern, levels)
+            ):
+                folders.append("/".join(levels))
+        return folders
+
+    def test_query_count_does_not_grow(self):
+        (small, small_paths) = self._create(2, 3, 4)
+        (large, large_paths) = self._create(8, 25, 40)
+
+        self.assertEqual(small.passed_through, [])
+        self.assertEqual(large.passed_through, [])
+        self.assertEqual(len(small.page_queries), len(create_project_folders.PREFETCH_FIELDS))
+        self.assertEqual(len(large.page_queries), len(small.page_queries))
+        self.assertTrue(len(large_paths) > len(small_paths))
+
+    def test_folders_match_project(self):
+        (_, paths) = self._create(3, 4, 5)
+
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertEqual(len(self._folders(paths, "sequences", None)), 3)
+        self.assertEqual(len(self._folders(paths, "sequences", None, None)), 12)
+        self.assertEqual(len(self._folders(paths, "assets", None, None)), 5)
+        for step in SHOT_STEPS:
+            self.assertEqual(len(self._folders(paths, "sequences", None, None, step)), 12)
+        for step in ASSET_STEPS:
+            self.assertEqual(len(self._folders(paths, "assets", None, None, step)), 5)
+        self.assertIn(os.path.join(self.project_root, "sequences", "sq001", "sq001_sh002", "comp"), paths)
+        self.assertIn(os.path.join(self.project_root, "assets", "Prop", "asset001", "rig"), paths)
+
+    def test_paging(self):
+        original = create_project_folders.PAGE_SIZE
+        create_project_folders.PAGE_SIZE = 10
+        try:
+            (sg, paths) = self._create(1, 25, 0)
+        finally:
+            create_project_folders.PAGE_SIZE = original
+
+        self.assertEqual(sg.passed_through, [])
+        self.assertEqual(len(self._folders(paths, "sequences", None, None)), 25)
+        self.assertEqual(
+            [page for (entity_type, _, page) in sg.page_queries if entity_type == "Shot"],
+            [1, 2, 3]
+        )
+
+    def test_cached_connection_is_restored(self):
+        (sg, _) = self._create(1, 1, 1)
+        self.assertIs(connection.get_sg_connection(), sg)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,252 @@
+# Copyright (c) 2018 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Tests for the background upload queue of
+hooks/tk-multi-publish2/upload_version.py.
+
+The hook is loaded through the core's hook loader, on top of a stand-in for
+the publisher's upload plugin. Shotgun is replaced by a connection whose
+upload method records its calls and can be told to fail or to take a while.
+
+The core of a pipeline configuration needs to be on the PYTHONPATH.
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from tank import hook
+except ImportError:
+    raise unittest.SkipTest("tk-core needs to be on the PYTHONPATH")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOOK_PATH = os.path.join(ROOT, "hooks", "tk-multi-publish2", "upload_version.py")
+
+
+class FakeShotgun(object):
+    """
+    Shotgun connection recording uploads. ``upload_thumbnail`` goes through
+    ``upload`` like it does in shotgun_api3.
+    """
+
+    def __init__(self, failures=0, duration=0):
+        """
+        :param int failures: Number of uploads which fail before they succeed.
+        :param float duration: Seconds each upload takes.
+        """
+        self.failures = failures
+        self.duration = duration
+        self.uploads = []
+        self._lock = threading.Lock()
+
+    def upload(self, entity_type, entity_id, path, field_name=None,
+               display_name=None, tag_list=None):
+        with self._lock:
+            self.uploads.append((entity_type, entity_id, path, field_name))
+            fail = self.failures > 0
+            if fail:
+                self.failures -= 1
+        time.sleep(self.duration)
+        if fail:
+            raise IOError("Connection reset by peer")
+        return len(self.uploads)
+
+    def upload_thumbnail(self, entity_type, entity_id, path, **kwargs):
+        return self.upload(entity_type, entity_id, path, field_name="thumb_image", **kwargs)
+
+
+class FakeUploadPlugin(hook.Hook):
+    """
+    Stands in for the publisher's upload plugin: uploads the movie and a
+    thumbnail of the item to a Version.
+    """
+
+    @property
+    def settings(self):
+        return {}
+
+    def publish(self, settings, item):
+        self.parent.shotgun.upload("Version", 1, item["movie"], "sg_uploaded_movie")
+        self.parent.shotgun.upload_thumbnail("Version", 1, item["thumbnail"])
+
+
+class FakeApp(object):
+
+    def __init__(self, shotgun):
+        self.shotgun = shotgun
+        self.logger = logging.getLogger("test_upload_version")
+
+
+class TestUploadQueue(unittest.TestCase):
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        self._queues = []
+
+        # the hook module, to reach UploadQueue and the per-process queue
+        plugin = hook.create_hook_instance([HOOK_PATH], FakeApp(None), base_class=FakeUploadPlugin)
+        self.module = type(plugin).publish.__globals__
+
+        self.movie = self._write("movie.mov", "frames")
+
+    def tearDown(self):
+        for upload_queue in self._queues:
+            upload_queue.stop()
+        self.module["_upload_queue"] = None
+        shutil.rmtree(self._folder)
+
+    def _write(self, name, content):
+        path = os.path.join(self._folder, name)
+        with open(path, "w") as fh:
+            fh.write(content)
+        return path
+
+    def _queue(self, shotgun, workers=1, **attributes):
+        """
+        Returns an upload queue on the test journal, with class attributes
+        (LEASE, BACKOFF, ...) overridden to keep the tests short.
+        """
+        attributes.setdefault("POLL_INTERVAL", 0.05)
+        queue_class = type("TestUploadQueue", (self.module["UploadQueue"],), attributes)
+        upload_queue = queue_class(
+            os.path.join(self._folder, "upload_queue.db"),
+            lambda: shotgun,
+            logging.getLogger("test_upload_version"),
+            workers
+        )
+        self._queues.append(upload_queue)
+        return upload_queue
+
+    def _jobs(self):
+        db = sqlite3.connect(os.path.join(self._folder, "upload_queue.db"))
+        try:
+            return db.execute(
+                "SELECT id, state, attempts, run_after, error FROM jobs ORDER BY id"
+            ).fetchall()
+        finally:
+            db.close()
+
+    def _wait_for(self, condition, timeout=10):
+        end = time.time() + timeout
+        while not condition():
+            if time.time() > end:
+                self.fail("Timed out, jobs: %s" % (self._jobs(),))
+            time.sleep(0.02)
+
+    def test_repeated_submits_are_deduplicated(self):
+        shotgun = FakeShotgun()
+        upload_queue = self._queue(shotgun)
+
+        job_id = upload_queue.submit("Version", 1, self.movie, "sg_uploaded_movie")
+        self.assertEqual(upload_queue.submit("Version", 1, self.movie, "sg_uploaded_movie"), job_id)
+        self.assertEqual(upload_queue.pending(), 1)
+
+        # another field or entity is another upload
+        self.assertNotEqual(upload_queue.submit("Version", 2, self.movie, "sg_uploaded_movie"), job_id)
+
+        upload_queue.start()
+        self._wait_for(lambda: upload_queue.pending() == 0)
+        self.assertEqual(len(shotgun.uploads), 2)
+
+        # the same file is not uploaded again once done...
+        self.assertEqual(upload_queue.submit("Version", 1, self.movie, "sg_uploaded_movie"), job_id)
+        self.assertEqual(upload_queue.pending(), 0)
+
+        # ...unless it changed
+        self._write("movie.mov", "more frames")
+        self.assertNotEqual(upload_queue.submit("Version", 1, self.movie, "sg_uploaded_movie"), job_id)
+        self._wait_for(lambda: upload_queue.pending() == 0)
+        self.assertEqual(len(shotgun.uploads), 3)
+
+    def test_failed_upload_is_retried_with_backoff(self):
+        shotgun = FakeShotgun(failures=2)
+        upload_queue = self._queue(shotgun, BACKOFF=0.5)
+        job_id = upload_queue.submit("Version", 1, self.movie, "sg_uploaded_movie")
+
+        begin = time.time()
+        upload_queue.start()
+        self._wait_for(lambda: self._jobs()[0][2] == 1)
+        (_, state, attempts, run_after, error) = self._jobs()[0]
+        self.assertEqual((state, attempts), ("pending", 1))
+        self.assertIn("Connection reset", error)
+        self.assertTrue(run_after >= begin + 0.5)
+
+        self._wait_for(lambda: upload_queue.pending() == 0)
+        # the second retry waits twice as long as the first one
+        self.assertTrue(time.time() - begin >= 0.5 + 1.0)
+        self.assertEqual(self._jobs()[0][:3], (job_id, "done", 2))
+        self.assertEqual(len(shotgun.uploads), 3)
+
+    def test_upload_gives_up_after_max_attempts(self):
+        shotgun = FakeShotgun(failures=10)
+        upload_queue = self._queue(shotgun, BACKOFF=0.01, MAX_ATTEMPTS=3)
+        upload_queue.submit("Version", 1, self.movie, "sg_uploaded_movie")
+
+        upload_queue.start()
+        self._wait_for(lambda: upload_queue.pending() == 0)
+        self.assertEqual(self._jobs()[0][1:3], ("failed", 3))
+        self.assertEqual(len(shotgun.uploads), 3)
+
+    def test_expired_lease_is_reclaimed(self):
+        upload_queue = self._queue(FakeShotgun(), LEASE=0.2)
+        job_id = upload_queue.submit("Version", 1, self.movie, "sg_uploaded_movie")
+
+        # a session claims the job, then dies without finishing it
+        self.assertEqual(upload_queue._claim()[0], job_id)
+        self.assertEqual(self._jobs()[0][1], "running")
+
+        # the lease is held by the dead session...
+        other_session = self._queue(FakeShotgun(), LEASE=0.2)
+        self.assertIsNone(other_session._claim())
+
+        # ...until it expires
+        time.sleep(0.3)
+        self.assertEqual(other_session._claim()[0], job_id)
+        self.assertIsNone(upload_queue._claim())
+
+    def test_lease_is_renewed_during_long_uploads(self):
+        shotgun = FakeShotgun(duration=1.0)
+        attributes = dict(LEASE=0.3, LEASE_RENEWAL=0.05)
+        sessions = [self._queue(shotgun, **attributes), self._queue(shotgun, **attributes)]
+        sessions[0].submit("Version", 1, self.movie, "sg_uploaded_movie")
+
+        for session in sessions:
+            session.start()
+        self._wait_for(lambda: sessions[0].pending() == 0)
+        self.assertEqual(len(shotgun.uploads), 1)
+
+    def test_publish_only_queues_the_movie(self):
+        shotgun = FakeShotgun()
+        upload_queue = self._queue(shotgun)
+        self.module["_upload_queue"] = upload_queue
+
+        plugin = hook.create_hook_instance([HOOK_PATH], FakeApp(shotgun), base_class=FakeUploadPlugin)
+        thumbnail = self._write("thumbnail.png", "pixels")
+        plugin.publish({}, {"movie": self.movie, "thumbnail": thumbnail})
+
+        # the thumbnail was uploaded inline, the movie is waiting in the queue
+        self.assertEqual(shotgun.uploads, [("Version", 1, thumbnail, "thumb_image")])
+        self.assertEqual(upload_queue.pending(), 1)
+        self.assertFalse("upload" in shotgun.__dict__)
+
+        upload_queue.start()
+        self._wait_for(lambda: upload_queue.pending() == 0)
+        self.assertEqual(shotgun.uploads[-1], ("Version", 1, self.movie, "sg_uploaded_movie"))
+
+
+if __name__ == "__main__":
+    unittest.main()